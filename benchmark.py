@@ -0,0 +1,363 @@
+"""
+Benchmark of generator.py against synthetic schemas, no MySQL server needed.
+
+A synthetic schema is served through a stand-in connection whose cursor returns the same row shapes as the
+INFORMATION_SCHEMA queries of table_definition, load_relation, load_const and schema_state. Every size runs in its
+own process so the peak memory of one size doesn't leak into the next.
+"""
+import argparse
+import json
+import logging
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+
+import generator
+
+column_types = ['int', 'bigint', 'varchar', 'text', 'decimal', 'date', 'datetime', 'tinyint', 'double', 'json']
+
+stages = [
+    'connection',
+    'schema_state',
+    'load_relation',
+    'table_definition',
+    'build_relation',
+    'load_consts',
+    'render_model',
+]
+
+
+def synthetic_schema(size, columns=8, fk_density=0.5, const_tables=0.02, seed=0):
+    """
+    Build the INFORMATION_SCHEMA rows of a schema with `size` tables of about `columns` columns, `fk_density`
+    foreign keys per table on average and a `const_tables` ratio of constant tables
+    """
+    rnd = random.Random(seed)
+
+    tables = ['table_%05d' % i for i in range(size)]
+    consts = set(rnd.sample(tables, max(1, int(size * const_tables)))) if size else set()
+
+    column_rows = []
+    relation_rows = []
+    const_rows = {}
+
+    for i, table in enumerate(tables):
+        rows = [(table, 'id', 'PRI', 'NO', 'int', 'auto_increment', None)]
+
+        if table in consts:
+            rows.append((table, 'code', 'UNI', 'NO', 'varchar', '', None))
+            rows.append((table, 'name', '', 'NO', 'varchar', '', None))
+            const_rows[table] = [('code %d' % n, n) for n in range(1, 21)]
+
+        for n in range(max(0, columns - len(rows) - 2)):
+            null = 'YES' if n % 3 == 0 else 'NO'
+            default = '0' if n % len(column_types) == 0 else None
+            rows.append((table, 'column_%02d' % n, '', null, column_types[n % len(column_types)], '', default))
+
+        if i % 2 == 0:
+            rows.append((table, 'created_at', '', 'YES', 'timestamp', '', None))
+            rows.append((table, 'updated_at', '', 'YES', 'timestamp', '', None))
+
+        if i % 10 == 0:
+            rows.append((table, 'deleted_at', '', 'YES', 'timestamp', '', None))
+
+        # foreign keys only point to earlier tables, a few of them with a role prefix
+        fks = int(fk_density) + (1 if rnd.random() < fk_density - int(fk_density) else 0)
+        for n in range(fks if i else 0):
+            parent = tables[rnd.randrange(i)]
+            column = ('%s_id' if n % 4 else 'created_by_%s_id') % parent
+            if any(row[1] == column for row in rows):
+                continue
+
+            rows.append((table, column, 'MUL', 'YES', 'int', '', None))
+            relation_rows.append((table, column, parent, 'id'))
+
+        column_rows.extend(rows)
+
+    counts = {}
+    for row in column_rows:
+        counts[row[0]] = counts.get(row[0], 0) + 1
+
+    state_rows = [(table, '2020-01-01 00:00:00', None, counts[table], counts[table] * 7919) for table in tables]
+
+    table_columns = {}
+    for row in column_rows:
+        table_columns.setdefault(row[0], []).append(row)
+
+    return {
+        'tables': tables,
+        'consts': const_rows,
+        'columns': column_rows,
+        'table_columns': table_columns,
+        'relations': relation_rows,
+        'state': state_rows,
+    }
+
+
+class FakeCursor:
+    """Cursor answering the generator queries from a synthetic schema"""
+
+    def __init__(self, schema):
+        self.schema = schema
+        self.rows = []
+
+    def execute(self, sql, params=None):
+        if 'INFORMATION_SCHEMA.STATISTICS' in sql:
+            # synthetic tables have no index besides their primary key, index scopes are not benchmarked
+            self.rows = []
+        elif 'TABLE_ROWS' in sql:
+            self.rows = [(table, 1000, 16384) for table in self.schema['tables']]
+        elif 'CRC32' in sql:
+            self.rows = self.schema['state']
+        elif 'INFORMATION_SCHEMA.TABLES' in sql:
+            self.rows = [(table,) for table in self.schema['tables']]
+        elif "COLUMN_KEY = 'PRI'" in sql:
+            self.rows = [row[:2] for row in self.schema['columns'] if row[2] == 'PRI']
+        elif 'INFORMATION_SCHEMA.COLUMNS' in sql and 'TABLE_NAME IN' in sql:
+            # streamed batch, the only column query with a plain list of tables as parameters
+            self.rows = [row for table in params for row in self.schema['table_columns'].get(table, [])]
+        elif 'KEY_COLUMN_USAGE' in sql and 'COUNT(*)' in sql:
+            counts = {}
+            for row in self.schema['relations']:
+                counts[row[0]] = counts.get(row[0], 0) + 1
+            self.rows = list(counts.items())
+        elif 'KEY_COLUMN_USAGE' in sql:
+            self.rows = self.schema['relations']
+        elif 'INFORMATION_SCHEMA.COLUMNS' in sql:
+            self.rows = self.schema['columns']
+        elif sql.startswith('CHECKSUM TABLE'):
+            self.rows = []
+            for name in sql[len('CHECKSUM TABLE '):].split(', '):
+                table = name.split('.')[-1].strip('`')
+                checksum = sum(value for code, value in self.schema['consts'].get(table, []))
+                self.rows.append(('benchmark.' + table, checksum))
+        else:
+            table = sql.split('FROM', 1)[1].split()[0].strip('`')
+            self.rows = self.schema['consts'].get(table, [])
+
+    def fetchall(self):
+        return list(self.rows)
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self, schema):
+        self.schema = schema
+
+    def cursor(self, *args, **kwargs):
+        return FakeCursor(self.schema)
+
+    def close(self):
+        pass
+
+
+def write_references(schema, path, ratio, lines=40):
+    """Reference files with user regions for a `ratio` of the models"""
+    rnd = random.Random(1)
+
+    for table in schema['tables']:
+        if rnd.random() >= ratio:
+            continue
+
+        name = generator.camelize(table)
+        body = '\n'.join('        $value%d = $this->id + %d;' % (n, n) for n in range(lines))
+        (path / (name + '.php')).write_text('''\
+<?php
+
+namespace App\\Models;
+
+//region {namespace}
+use App\\Traits\\HasAudit;
+//endregion
+
+class {name} extends Eloquent implements Auditable
+{{
+    use HasAudit;
+
+    protected $table = '{table}';
+
+    //region {function}
+    public function userDefined()
+    {{
+{body}
+    }}
+    //endregion
+}}
+'''.format(namespace=generator.namespace_mark, function=generator.function_mark, name=name, table=table, body=body))
+
+
+def write_config(schema, path):
+    consts = '\n'.join('%s: id' % table for table in sorted(schema['consts']))
+
+    config = path / 'generator.ini'
+    config.write_text('''\
+[options]
+namespace: App\\Models
+result_path: {result}
+reference_path: {reference}
+history_table_suffix: _history
+always_add_region: true
+cache_path: {cache}
+ignored_table:
+hidden_column:
+
+[db]
+database: benchmark
+
+[cast]
+column_0*: string
+
+[constant]
+default_value_column:
+  code
+
+[constant/key_column]
+{consts}
+
+[constant/value_column]
+'''.format(result=path / 'models', reference=path / 'reference', cache=path / 'generator.cache', consts=consts))
+
+    return config
+
+
+def timed(timings, name, func):
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            timings[name] = timings.get(name, 0.0) + time.perf_counter() - start
+
+    return wrapper
+
+
+def peak_memory():
+    """Peak resident memory of this process in MB"""
+    if resource is None:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def run_one(size, columns, fk_density, const_tables, references, jobs, stream=None):
+    """Run the generator twice against a synthetic schema: from scratch then with a warm cache"""
+    logging.getLogger(generator.__name__).setLevel(logging.WARNING)
+
+    start = time.perf_counter()
+    schema = synthetic_schema(size, columns, fk_density, const_tables)
+    build_time = time.perf_counter() - start
+
+    timings = {}
+    connect = timed(timings, 'connection', lambda **kwargs: FakeConnection(schema))
+    generator.connection = SimpleNamespace(MySQLConnection=connect)
+    for name in stages[1:]:
+        setattr(generator, name, timed(timings, name, getattr(generator, name)))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp)
+        (path / 'reference').mkdir()
+        write_references(schema, path / 'reference', references)
+        config = write_config(schema, path)
+
+        start = time.perf_counter()
+        generator.main(str(config), jobs=jobs, stream=stream)
+        wall = time.perf_counter() - start
+
+        cold = dict(timings)
+        timings.clear()
+
+        start = time.perf_counter()
+        generator.main(str(config), jobs=jobs, stream=stream)
+        warm = time.perf_counter() - start
+
+    result = {
+        'tables': size,
+        'columns': len(schema['columns']),
+        'relations': len(schema['relations']),
+        'schema_build': round(build_time, 4),
+        'wall': round(wall, 4),
+        'warm_wall': round(warm, 4),
+        'peak_mb': peak_memory(),
+        'stages': {name: round(cold.get(name, 0.0), 4) for name in stages},
+    }
+    result['stages']['write_and_other'] = round(wall - sum(cold.values()), 4)
+
+    return result
+
+
+report_columns = ['tables', 'columns', 'wall', 'warm_wall', 'peak_mb'] + stages + ['write_and_other']
+
+
+def report(result=None):
+    """Print the header, or the row of a result"""
+    if result is None:
+        values = report_columns
+    else:
+        values = [result[h] if h in result else result['stages'][h] for h in report_columns]
+
+    print(' '.join('%16s' % v for v in values))
+    sys.stdout.flush()
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Benchmark generator.py against synthetic schemas')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000, 10000, 50000],
+                        help='number of tables of each synthetic schema')
+    parser.add_argument('--columns', type=int, default=8, help='columns per table')
+    parser.add_argument('--fk-density', type=float, default=0.5, help='foreign keys per table')
+    parser.add_argument('--const-tables', type=float, default=0.02, help='ratio of constant tables')
+    parser.add_argument('--references', type=float, default=0.2, help='ratio of models with a reference file')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='generator render processes')
+    parser.add_argument('--stream', type=int, metavar='TABLES', help='generate in streamed batches of this size')
+    parser.add_argument('--json', metavar='PATH', help='also write the results to a JSON file')
+    parser.add_argument('--single', action='store_true', help=argparse.SUPPRESS)
+
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = parse_args(argv)
+    options = [args.columns, args.fk_density, args.const_tables, args.references, args.jobs]
+
+    if args.single:
+        print(json.dumps(run_one(args.sizes[0], *options, stream=args.stream)))
+        return
+
+    report()
+
+    results = []
+    for size in args.sizes:
+        # one process per size, for an honest peak memory
+        output = subprocess.check_output([
+            sys.executable, __file__, '--single',
+            '--sizes', str(size),
+            '--columns', str(args.columns),
+            '--fk-density', str(args.fk_density),
+            '--const-tables', str(args.const_tables),
+            '--references', str(args.references),
+            '--jobs', str(args.jobs),
+        ] + (['--stream', str(args.stream)] if args.stream else []))
+        results.append(json.loads(output.decode('utf-8').splitlines()[-1]))
+        report(results[-1])
+
+    if args.json:
+        Path(args.json).write_text(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -3,15 +3,25 @@ Created on 4/20/2016
 
 @author: Azhar
 """
+import argparse
+import cProfile
+import gzip
+import hashlib
+import json
 import logging
+import multiprocessing
 import os
+import posixpath
 import re
+import string
 import sys
-from collections import defaultdict, OrderedDict
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from configparser import ConfigParser
-from contextlib import closing
-from fnmatch import fnmatch
-from functools import lru_cache
+from contextlib import closing, contextmanager
+from fnmatch import fnmatchcase, translate
 from pathlib import Path
 
 import yaml
@@ -20,9 +30,59 @@ from mysql.connector import connection
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(process)d:%(name)s - %(levelname)s - %(message)s')
 _log = logging.getLogger(__name__)
 
+local = Path(os.path.realpath(os.path.dirname(__file__)))
+
 namespace_mark = '### Additional namespace #'
 function_mark = '### User defined function #'
 
+cache_version = 1
+manifest_version = 1
+
+snapshot_format = 'eloquent-model-snapshot'
+snapshot_version = 3
+
+commands = ['generate', 'snapshot', 'watch']
+
+columns_sql = '''\
+SELECT TABLE_NAME, COLUMN_NAME, COLUMN_KEY, IS_NULLABLE, DATA_TYPE, EXTRA, COLUMN_DEFAULT
+FROM INFORMATION_SCHEMA.COLUMNS
+WHERE TABLE_SCHEMA = DATABASE()
+'''
+
+tables_sql = '''\
+SELECT TABLE_NAME
+FROM INFORMATION_SCHEMA.TABLES
+WHERE TABLE_SCHEMA = DATABASE()
+'''
+
+keys_sql = '''\
+SELECT TABLE_NAME, COLUMN_NAME
+FROM INFORMATION_SCHEMA.COLUMNS
+WHERE TABLE_SCHEMA = DATABASE()
+  AND COLUMN_KEY = 'PRI'
+ORDER BY TABLE_NAME, ORDINAL_POSITION
+'''
+
+statistics_sql = '''\
+SELECT TABLE_NAME, INDEX_NAME, SEQ_IN_INDEX, COLUMN_NAME
+FROM INFORMATION_SCHEMA.STATISTICS
+WHERE TABLE_SCHEMA = DATABASE()
+'''
+
+table_rows_sql = '''\
+SELECT TABLE_NAME, TABLE_ROWS, DATA_LENGTH
+FROM INFORMATION_SCHEMA.TABLES
+WHERE TABLE_SCHEMA = DATABASE()
+'''
+
+relation_sql = '''\
+SELECT TABLE_NAME, COLUMN_NAME, REFERENCED_TABLE_NAME, REFERENCED_COLUMN_NAME
+FROM INFORMATION_SCHEMA.KEY_COLUMN_USAGE
+WHERE TABLE_SCHEMA = DATABASE()
+  AND REFERENCED_TABLE_SCHEMA = DATABASE()
+  AND REFERENCED_TABLE_NAME IS NOT NULL
+'''
+
 default_type = 'mixed'
 date_type = 'date:Y-m-d'
 datetime_type = 'datetime'
@@ -32,6 +92,54 @@ integer_type = 'integer'
 boolean_type = 'boolean'
 float_type = 'float'
 
+# parameter type of the index scopes, other types are left without a type declaration
+scope_type = {
+    integer_type: 'int',
+    float_type: 'float',
+    string_type: 'string',
+    boolean_type: 'bool',
+}
+
+const_cache_ttl = 3600
+const_cache_tag = 'constants'
+
+# class aliases registered by Laravel at runtime, declared by the preload script so the models extending them link
+facade_aliases = {
+    'Eloquent': 'Illuminate\\Database\\Eloquent\\Model',
+}
+
+# eager_load entry standing for every parent relation to another constant table
+eager_load_auto = 'auto'
+
+unindexed_where_modes = ['', 'warn', 'drop']
+unindexed_warning = 'not indexed, full table scan'
+
+# EXTRA of the columns computed by the database, never written by the model
+generated_extra = ['VIRTUAL GENERATED', 'STORED GENERATED']
+
+# COLUMN_DEFAULT evaluated by the database. MySQL 8 flags them with DEFAULT_GENERATED in EXTRA, but neither MySQL 5.7
+# nor MariaDB do, they are told apart from the literals by the functions a default may call, as an unquoted string
+# default such as foo(bar) is a literal on MySQL 5.7
+default_expression = re.compile(
+    r'^(?:(?:current_timestamp|current_date|current_time|localtime|localtimestamp)(?:\(\d*\))?'
+    r'|(?:now|sysdate|curdate|curtime|utc_timestamp|utc_date|utc_time|unix_timestamp|uuid|uuid_short)\(\d*\)'
+    r'|uuid_to_bin\(uuid\(\)(?:,\s*[01])?\))$', re.IGNORECASE)
+
+# column types worth keeping out of the serialized models
+large_types = ['text', 'mediumtext', 'longtext', 'blob', 'mediumblob', 'longblob']
+
+audit_checks = [
+    ('unindexed_foreign_key', 'Relations without a supporting index'),
+    ('large_table_key', 'Large tables without an auto-increment primary key'),
+    ('large_column', 'Large columns serialized with the model'),
+    ('fan_out', 'Relations likely to cause N+1 fan-out'),
+]
+audit_table_rows = 1000000
+audit_fan_out = 100
+
+# appended to the all() and get() annotations of the tables past the bulk thresholds
+bulk_warning = 'full table load, iterate with lazyByKey() or chunkByKey()'
+
 column_type = {
     'created_at': datetime_type,
     'updated_at': datetime_type,
@@ -70,119 +178,653 @@ type_map = {
 title_trans = ''.join(chr(c) if chr(c).isalnum() else '_' for c in range(256))
 
 
-@lru_cache(maxsize=128)
+# suffix the noun must end with, the part replaced and its replacement, the first matching rule applies
+plural_rules = (
+    ('[ml]ouse', '([ml])ouse$', '\\1ice'),
+    ('child', 'child$', 'children'),
+    ('booth', 'booth$', 'booths'),
+    ('foot', 'foot$', 'feet'),
+    ('ooth', 'ooth$', 'eeth'),
+    ('l[eo]af', 'l([eo])af$', 'l\\1aves'),
+    ('sis', 'sis$', 'ses'),
+    ('man', 'man$', 'men'),
+    ('ife', 'ife$', 'ives'),
+    ('eau', 'eau$', 'eaux'),
+    ('lf', 'lf$', 'lves'),
+    ('[sxz]', '$', 'es'),
+    ('[^aeioudgkprt]h', '$', 'es'),
+    ('(?:qu|[^aeiou])y', 'y$', 'ies'),
+    ('', '$', 's'),
+)
+
+
+class Inflector(object):
+    """
+    Camel case and plural forms of names, with configurable irregular and uncountable words. The plural rules are
+    tried in a single regex whose alternatives keep their order, and every result is cached for the whole run, the
+    caches grow with the number of distinct names of the schema
+    """
+    __slots__ = ['irregular', 'uncountable', 'suffix', 'replacements', 'camels', 'plurals']
+
+    camel_pattern = re.compile(r'_([a-z0-9])')
+    last_word_pattern = re.compile(r'[A-Z]?[^A-Z]*\Z')
+
+    def __init__(self, irregular=None, uncountable=()):
+        self.irregular = {k.lower(): v for k, v in (irregular or {}).items()}
+        self.uncountable = {word.lower() for word in uncountable}
+
+        self.suffix = re.compile('(?s)(?:%s)\\Z' % '|'.join(
+            '(?P<r%d>.*%s)' % (i, pattern) for i, (pattern, search, replace) in enumerate(plural_rules)))
+        self.replacements = [(re.compile(search), replace) for pattern, search, replace in plural_rules]
+
+        self.camels = {}
+        self.plurals = {}
+
+    def camelize(self, text):
+        try:
+            return self.camels[text]
+        except KeyError:
+            pass
+
+        lower = text.lower()
+        result = self.camels[text] = str(lower[0].upper() +
+                                         self.camel_pattern.sub(lambda m: m.group(1).upper(), lower[1:]))
+        return result
+
+    def plural(self, noun):
+        try:
+            return self.plurals[noun]
+        except KeyError:
+            pass
+
+        result = self.plurals[noun] = self.inflect(noun)
+        return result
+
+    def inflect(self, noun):
+        if self.irregular or self.uncountable:
+            # irregular and uncountable words apply to the last word of a camel case name
+            last = self.last_word_pattern.search(noun)
+            word = last.group().lower()
+
+            if word in self.uncountable:
+                return noun
+
+            if word in self.irregular:
+                result = self.irregular[word]
+                if last.group()[:1].isupper():
+                    result = result[:1].upper() + result[1:]
+
+                return noun[:last.start()] + result
+
+        match = self.suffix.match(noun)
+        search, replace = self.replacements[int(match.lastgroup[1:])]
+        return search.sub(replace, noun, 1)
+
+    def plural_all(self, nouns):
+        """Plural of every noun, each distinct noun inflected once"""
+        missing = set(nouns).difference(self.plurals)
+        for noun in missing:
+            self.plurals[noun] = self.inflect(noun)
+
+        return [self.plurals[noun] for noun in nouns]
+
+
+inflector = Inflector()
+
+
 def camelize(text):
-    text = text.lower()
-    return str(text[0].upper() +
-               re.sub(r'_([a-z0-9])', lambda m: m.group(1).upper(), text[1:]))
+    return inflector.camelize(text)
 
 
-@lru_cache(maxsize=128)
 def plural(noun):
-    rules = (
-        ('[ml]ouse$', '([ml])ouse$', '\\1ice'),
-        ('child$', 'child$', 'children'),
-        ('booth$', 'booth$', 'booths'),
-        ('foot$', 'foot$', 'feet'),
-        ('ooth$', 'ooth$', 'eeth'),
-        ('l[eo]af$', 'l([eo])af$', 'l\\1aves'),
-        ('sis$', 'sis$', 'ses'),
-        ('man$', 'man$', 'men'),
-        ('ife$', 'ife$', 'ives'),
-        ('eau$', 'eau$', 'eaux'),
-        ('lf$', 'lf$', 'lves'),
-        ('[sxz]$', '$', 'es'),
-        ('[^aeioudgkprt]h$', '$', 'es'),
-        ('(qu|[^aeiou])y$', 'y$', 'ies'),
-        ('$', '$', 's')
-    )
+    return inflector.plural(noun)
 
-    def regexs():
-        for rule in rules:
-            pattern, search, replace = rule
-            yield lambda word: re.search(pattern, word) and re.sub(search, replace, word)
-
-    for regex in regexs():
-        result = regex(noun)
-        if result:
-            return result
-
-
-def table_definition(cnx):
-    tables = defaultdict(lambda: {
-        'class': None,
-        'key': 'id',
-        'autoincrement': 'false',
-        'timestamps': 'false',
-        'column': OrderedDict(),
-        'fillable': [],
-        'date': [],
-        'null': [],
-        'parent': OrderedDict(),
-        'child': OrderedDict(),
-    })
 
-    with closing(cnx.cursor()) as cursor:
-        cursor.execute('''\
-SELECT TABLE_NAME, COLUMN_NAME, COLUMN_KEY, IS_NULLABLE, DATA_TYPE, EXTRA
-FROM INFORMATION_SCHEMA.COLUMNS
-WHERE TABLE_SCHEMA = DATABASE()
-''')
+class Profile(object):
+    """Wall and cpu time spent per stage and per table, with row, byte and file counters, of a generation run"""
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.reset()
 
-        for table, column, key, null, col_type, extra in cursor:
-            properties = tables[table]
-            properties['name'] = camelize(table)
+    def reset(self):
+        self.stages = {}
+        self.tables = {}
+        self.counters = {}
 
-            if key == 'PRI':
-                properties['key'] = column
+    @contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield
+        finally:
+            self.add_stage(name, time.perf_counter() - wall, time.process_time() - cpu)
+
+    def add_stage(self, name, wall, cpu, calls=1):
+        with self.lock:
+            stage = self.stages.setdefault(name, [0.0, 0.0, 0])
+            stage[0] += wall
+            stage[1] += cpu
+            stage[2] += calls
+
+    def count(self, name, value=1):
+        if self.enabled:
+            with self.lock:
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    def export(self):
+        return {
+            'stages': {name: {'wall': wall, 'cpu': cpu, 'calls': calls}
+                       for name, (wall, cpu, calls) in self.stages.items()},
+            'tables': {table: {'wall': wall, 'cpu': cpu} for table, (wall, cpu) in self.tables.items()},
+            'counters': dict(self.counters),
+        }
+
+    def merge(self, data):
+        """Add what a render worker process recorded"""
+        for name, stage in data['stages'].items():
+            self.add_stage(name, stage['wall'], stage['cpu'], stage['calls'])
+
+        for table, timing in data['tables'].items():
+            self.tables[table] = (timing['wall'], timing['cpu'])
+
+        for name, value in data['counters'].items():
+            self.count(name, value)
+
+    def write(self, path):
+        path.write_text(json.dumps(self.export(), indent=2, sort_keys=True))
+
+
+profile = Profile()
+
+_interned = {}
+# Column instances by name and type, apart from the interned values a fillable tuple could be equal to
+_columns = {}
+
+
+def interned(value):
+    """Share a single instance of equal immutable values, column name tuples and sets, between every table"""
+    return _interned.setdefault(value, value)
+
+
+class Column(object):
+    """Column of a table, immutable so equal columns of different tables share one instance"""
+    __slots__ = ['name', 'type']
+
+    def __init__(self, name, type_):
+        self.name = sys.intern(name)
+        self.type = type_
+
+    def __repr__(self):
+        return 'Column(%r, %r)' % (self.name, self.type)
+
+
+class ForeignKey(object):
+    """Foreign key column, shared by the parent side of the child table and the child side of the parent table"""
+    __slots__ = ['table', 'column', 'ref_table', 'ref_column']
+
+    def __init__(self, table, column, ref_table, ref_column):
+        self.table = table
+        self.column = column
+        self.ref_table = ref_table
+        self.ref_column = ref_column
+
+    def __repr__(self):
+        return 'ForeignKey(%r, %r, %r, %r)' % (self.table, self.column, self.ref_table, self.ref_column)
+
+
+class Table(object):
+    """
+    Definition of a table, columns by name, and its relations by related table then by column. Once loaded, the
+    column name sets are interned frozensets. namespace is only set on the tables of another schema, primary is the
+    number of columns of the primary key, key being the last of them. indexes stays None until the indexes of the
+    table are loaded
+    """
+    __slots__ = ['name', 'model', 'namespace', 'key', 'primary', 'autoincrement', 'timestamps', 'columns', 'fillable',
+                 'nullable', 'date', 'hidden', 'large', 'defaults', 'computed', 'parent', 'child', 'indexes', 'rows',
+                 'size']
+
+    def __init__(self, name):
+        self.name = name
+        self.model = camelize(name)
+        self.namespace = None
+        self.key = 'id'
+        self.primary = 0
+        self.autoincrement = False
+        self.timestamps = False
+        self.columns = {}
+        self.fillable = []
+        self.nullable = set()
+        self.date = set()
+        self.hidden = set()
+        self.large = set()
+        self.defaults = {}
+        self.computed = {}
+        self.parent = {}
+        self.child = {}
+        self.indexes = None
+        self.rows = None
+        self.size = None
+
+    def freeze(self):
+        self.fillable = interned(tuple(self.fillable))
+        self.nullable = interned(frozenset(self.nullable))
+        self.date = interned(frozenset(self.date))
+        self.hidden = interned(frozenset(self.hidden))
+        self.large = interned(frozenset(self.large))
+
+    def __repr__(self):
+        return 'Table(%r)' % self.name
+
+
+class CastRules(object):
+    """
+    Cast patterns of a table compiled once. Plain names are looked up in a dict, wildcard patterns are tried in a
+    single regex whose alternatives keep the order of the rules, and the rule with the lowest position wins, as
+    with fnmatch tried on each rule in order. Resolved columns are memoized
+    """
+    __slots__ = ['casts', 'exact', 'pattern', 'resolved']
+
+    def __init__(self, rules):
+        self.casts = list(rules.values())
+        self.exact = {}
+        self.resolved = {}
+
+        alternatives = []
+        for i, rule in enumerate(rules):
+            rule = os.path.normcase(rule)
+            if any(c in rule for c in '*?['):
+                alternatives.append('(?P<r%d>%s)' % (i, translate(rule)))
+            else:
+                self.exact.setdefault(rule, i)
+
+        self.pattern = re.compile('|'.join(alternatives)) if alternatives else None
+
+    def cast(self, column):
+        """Cast of the first rule matching the column, None if none match"""
+        try:
+            return self.resolved[column]
+        except KeyError:
+            pass
+
+        name = os.path.normcase(column)
+        position = self.exact.get(name)
+
+        if self.pattern is not None:
+            match = self.pattern.match(name)
+            if match is not None:
+                i = int(match.lastgroup[1:])
+                if position is None or i < position:
+                    position = i
+
+        cast = self.resolved[column] = None if position is None else self.casts[position]
+        return cast
+
+
+def cast_rules(casts_fields):
+    """Compile the cast rules of every table, the per table rules merged over the global ones"""
+    default = casts_fields.get(None, {})
+
+    rules = {None: CastRules(default)}
+    for table, fields in casts_fields.items():
+        if table is not None:
+            merged = default.copy()
+            merged.update(fields)
+            rules[table] = CastRules(merged)
+
+    return rules
+
+
+def build_tables(rows, settings):
+    tables = {}
+
+    hidden_column = settings['hidden_column']
+    hidden_columns = settings['hidden_columns']
+
+    for table, column, key, null, col_type, extra, default in rows:
+        properties = tables.get(table)
+        if properties is None:
+            properties = tables[table] = Table(table)
+
+        if key == 'PRI':
+            properties.key = column
+            properties.primary += 1
+
+        if 'auto_increment' in extra:
+            properties.autoincrement = True
+
+        if null == 'YES':
+            properties.nullable.add(column)
+
+        generated = next((flag for flag in generated_extra if flag in extra.upper()), None)
+        if column not in ['id', 'created_at', 'updated_at', 'deleted_at']:
+            if generated is None:
+                properties.fillable.append(column)
+        elif column in ['created_at', 'updated_at']:
+            properties.timestamps = True
+
+        # values the database fills in on insert, the timestamps are set by the model itself
+        if column not in ['created_at', 'updated_at', 'deleted_at']:
+            if generated is not None:
+                properties.computed[column] = generated
+            elif default is not None and default != 'NULL':
+                default = str(default)
+                if 'DEFAULT_GENERATED' in extra.upper() or default_expression.match(default):
+                    properties.computed[column] = default
+                elif len(default) > 1 and default[0] == default[-1] == "'":
+                    # MariaDB quotes the string literals
+                    properties.defaults[column] = default[1:-1].replace("''", "'")
+                else:
+                    properties.defaults[column] = default
 
-            if 'auto_increment' in extra:
-                properties['autoincrement'] = 'true'
+        if column in hidden_columns.get(table, []) or column in hidden_column:
+            properties.hidden.add(column)
 
-            if null == 'YES':
-                properties['null'].append(column)
+        if col_type in large_types:
+            properties.large.add(column)
 
-            if column not in ['id', 'created_at', 'updated_at', 'deleted_at']:
-                properties['fillable'].append(column)
-            elif column in ['created_at', 'updated_at']:
-                properties['timestamps'] = 'true'
+        type_ = column_type.get(column)
+        if type_ is None:
+            type_ = type_map.get(col_type, default_type)
+            if type_ in [datetime_type, date_type]:
+                properties.date.add(column)
+        elif column in ['deleted_at']:
+            properties.date.add(column)
 
-            type_ = column_type.get(column)
-            if type_ is None:
-                type_ = type_map.get(col_type, default_type)
-                if type_ in [datetime_type, date_type]:
-                    properties['date'].append(column)
-            elif column in ['deleted_at']:
-                properties['date'].append(column)
+        definition = _columns.get((column, type_))
+        if definition is None:
+            definition = _columns[(column, type_)] = Column(column, type_)
 
-            properties['column'][column] = type_
+        properties.columns[column] = definition
+
+    for properties in tables.values():
+        properties.freeze()
 
     return tables
 
 
-def load_relation(cnx, tables, ignore):
+def build_relation(tables, rows, ignore):
+    for table, column, ref_table, ref_column in rows:
+        if table_matches(table, ignore) or table_matches(ref_table, ignore):
+            continue
+
+        if table not in tables or ref_table not in tables:
+            continue
+
+        foreign_key = ForeignKey(table, column, ref_table, ref_column)
+        tables[table].parent.setdefault(ref_table, {})[column] = foreign_key
+        tables[ref_table].child.setdefault(table, {})[column] = foreign_key
+
+
+def build_indexes(tables, rows, names=None):
+    """
+    Set the indexes of the tables, by name with their columns in index order. A functional key part ends the
+    usable columns of its index. The named tables, every table by default, are known to have no other index
+    """
+    for table in tables if names is None else names:
+        if table in tables:
+            tables[table].indexes = ()
+
+    indexes = defaultdict(dict)
+    for table, index, seq, column in rows:
+        if table in tables:
+            indexes[table].setdefault(index, []).append((int(seq), column))
+
+    for table, table_indexes in indexes.items():
+        result = []
+        for index in sorted(table_indexes):
+            columns = []
+            for seq, column in sorted(table_indexes[index]):
+                if column is None:
+                    break
+                columns.append(column)
+
+            if columns:
+                result.append((index, tuple(columns)))
+
+        tables[table].indexes = tuple(result)
+
+
+def index_prefixes(properties):
+    """Leftmost column prefixes of the indexes of a table, the primary key first, each with the index serving it"""
+    prefixes = {}
+    for index, columns in sorted(properties.indexes or (), key=lambda x: (x[0] != 'PRIMARY', x[0])):
+        for i in range(1, len(columns) + 1):
+            prefixes.setdefault(columns[:i], index)
+
+    return list(prefixes.items())
+
+
+def scope_params(properties, columns, prop_types):
+    """Type declaration, variable and documented type of the parameters of an index scope"""
+    params = []
+    for column in columns:
+        variable = camelize(column)
+        variable = '$%s%s' % (variable[:1].lower(), variable[1:])
+        if variable == '$query':
+            variable = '$queryValue'
+
+        hint = scope_type.get(properties.columns[column].type)
+        if hint is None:
+            params.append(('', variable, prop_types.get(column, 'mixed')))
+        elif column in properties.nullable:
+            params.append(('', variable, 'null|' + hint))
+        else:
+            params.append((hint + ' ', variable, hint))
+
+    return params
+
+
+def uses_indexes(settings):
+    return settings['index_scope'] or bool(settings['unindexed_where'])
+
+
+def loads_indexes(settings):
+    """Whether the indexes are loaded, for the models or for the audit"""
+    return uses_indexes(settings) or settings['audit']
+
+
+def loads_table_rows(settings):
+    """Whether the row counts are loaded, for the bulk helpers or for the audit"""
+    return bool(settings['bulk_table_rows'] or settings['bulk_table_size']) or settings['audit']
+
+
+def build_table_rows(tables, rows):
+    """Set the estimated row count and data size of the tables, from INFORMATION_SCHEMA.TABLES"""
+    for table, count, size in rows:
+        if table not in tables:
+            continue
+
+        if count is not None:
+            tables[table].rows = int(count)
+
+        if size is not None:
+            tables[table].size = int(size)
+
+
+def bulk_table(rows, size, settings):
+    """Whether a table of about `rows` rows and `size` bytes of data gets the bulk iteration helpers"""
+    max_rows = settings['bulk_table_rows']
+    max_size = settings['bulk_table_size']
+
+    return bool(max_rows and rows is not None and int(rows) >= max_rows or
+                max_size and size is not None and int(size) >= max_size * 1024 * 1024)
+
+
+def glob_like(pattern):
+    """Translate a glob pattern into a LIKE pattern escaped with |"""
+    pattern = pattern.replace('|', '||').replace('%', '|%').replace('_', '|_')
+    return pattern.replace('*', '%').replace('?', '_')
+
+
+def glob_regexp(pattern):
+    """Translate a glob pattern using character classes into an anchored REGEXP pattern"""
+    result = []
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == '*':
+            result.append('.*')
+        elif c == '?':
+            result.append('.')
+        elif c == '[' and ']' in pattern[i + 2:]:
+            j = pattern.index(']', i + 2)
+            chars = pattern[i + 1:j]
+            if chars.startswith('!'):
+                chars = '^' + chars[1:]
+            result.append('[%s]' % chars)
+            i = j
+        else:
+            result.append(re.escape(c))
+        i += 1
+
+    return '^%s$' % ''.join(result)
+
+
+def glob_condition(column, patterns):
+    """
+    SQL condition matching a column against any of the glob patterns, and its parameters. The names of
+    INFORMATION_SCHEMA are utf8mb3, compared with its binary collation to match case-sensitively like table_matches
+    """
+    conditions = []
+    params = []
+    for pattern in patterns:
+        if '[' in pattern:
+            conditions.append('%s COLLATE utf8_bin REGEXP %%s' % column)
+            params.append(glob_regexp(pattern))
+        else:
+            conditions.append("%s COLLATE utf8_bin LIKE %%s ESCAPE '|'" % column)
+            params.append(glob_like(pattern))
+
+    return '(%s)' % ' OR '.join(conditions), params
+
+
+def table_matches(table, patterns):
+    return any(fnmatchcase(table, pattern) for pattern in patterns)
+
+
+def table_selected(table, settings):
+    """Whether a model is generated for the table"""
+    if settings['include'] and not table_matches(table, settings['include']):
+        return False
+
+    return not table_matches(table, settings['ignore'])
+
+
+def columns_query(settings, related=()):
+    """
+    Column scan restricted to the selected tables, plus the tables related to them and their history tables
+    which relation naming and history methods still need
+    """
+    include = settings['include']
+    ignore = settings['ignore']
+    history_suffix = settings['history_suffix']
+
+    if not include and not ignore:
+        return columns_sql, None
+
+    selected = []
+    params = []
+    if include:
+        condition, values = glob_condition('TABLE_NAME', include)
+        selected.append(condition)
+        params.extend(values)
+
+    if ignore:
+        condition, values = glob_condition('TABLE_NAME', ignore)
+        selected.append('NOT %s' % condition)
+        params.extend(values)
+
+    conditions = ['(%s)' % ' AND '.join(selected)]
+
+    if history_suffix:
+        condition, values = glob_condition('TABLE_NAME', [pattern + history_suffix for pattern in include or ['*']])
+        conditions.append(condition)
+        params.extend(values)
+
+    if related:
+        related = sorted(related)
+        conditions.append('TABLE_NAME IN (%s)' % ', '.join(['%s'] * len(related)))
+        params.extend(related)
+
+    return '%s  AND (%s)\n' % (columns_sql, ' OR '.join(conditions)), params
+
+
+def relation_query(settings):
+    """Relation scan restricted to the foreign keys with at least one side selected and none ignored"""
+    include = settings['include']
+    ignore = settings['ignore']
+
+    if not include and not ignore:
+        return relation_sql, None
+
+    sql = relation_sql
+    params = []
+    if ignore:
+        for column in ['TABLE_NAME', 'REFERENCED_TABLE_NAME']:
+            condition, values = glob_condition(column, ignore)
+            sql += '  AND NOT %s\n' % condition
+            params.extend(values)
+
+    if include:
+        condition, values = glob_condition('TABLE_NAME', include)
+        ref_condition, ref_values = glob_condition('REFERENCED_TABLE_NAME', include)
+        sql += '  AND (%s OR %s)\n' % (condition, ref_condition)
+        params.extend(values + ref_values)
+
+    return sql, params
+
+
+def in_schemas(sql, params, schemas, columns='TABLE_SCHEMA'):
+    """
+    Query of the current database rewritten for a list of schemas: the schema columns are selected and grouped by
+    first, and each DATABASE() condition becomes a list of the schemas, its parameters coming before the others
+    """
+    count = sql.count('= DATABASE()')
+    sql = sql.replace('SELECT ', 'SELECT %s, ' % columns, 1).replace('GROUP BY ', 'GROUP BY %s, ' % columns)
+    sql = sql.replace('= DATABASE()', 'IN (%s)' % ', '.join(['%s'] * len(schemas)))
+
+    return sql, list(schemas) * count + list(params or [])
+
+
+def quote_name(name):
+    """Backtick quoted identifier, for the statements taking no parameter in place of a name"""
+    return '`%s`' % name.replace('`', '``')
+
+
+def related_tables(relations, settings):
+    """Tables on the other side of the relations, only needed when not every table is selected"""
+    if not settings['include']:
+        return ()
+
+    return {table for row in relations for table in (row[0], row[2])}
+
+
+def table_definition(cnx, settings, related=()):
     with closing(cnx.cursor()) as cursor:
-        cursor.execute('''\
-SELECT TABLE_NAME, COLUMN_NAME, REFERENCED_TABLE_NAME, REFERENCED_COLUMN_NAME
-FROM INFORMATION_SCHEMA.KEY_COLUMN_USAGE
-WHERE TABLE_SCHEMA = DATABASE()
-  AND REFERENCED_TABLE_SCHEMA = DATABASE()
-  AND REFERENCED_TABLE_NAME IS NOT NULL
-''')
+        cursor.execute(*columns_query(settings, related))
+        tables = build_tables(cursor, settings)
 
-        for table, column, ref_table, ref_column in cursor:
-            if table in ignore or ref_table in ignore:
-                continue
+    if profile.enabled:
+        profile.count('rows.columns', sum(len(properties.columns) for properties in tables.values()))
+
+    return tables
 
-            if ref_table not in tables[table]['parent']:
-                tables[table]['parent'][ref_table] = \
-                    OrderedDict()
 
-            if table not in tables[ref_table]['child']:
-                tables[ref_table]['child'][table] = OrderedDict()
+def load_relation(cnx, settings):
+    with closing(cnx.cursor()) as cursor:
+        cursor.execute(*relation_query(settings))
+        rows = cursor.fetchall()
+
+    profile.count('rows.relations', len(rows))
 
-            tables[table]['parent'][ref_table][column] = ref_column
-            tables[ref_table]['child'][table][column] = ref_column
+    return rows
 
 
 def load_const(cnx, table, keys, value):
@@ -198,6 +840,7 @@ ORDER BY {value}
 
         fields = {}
         for r in cursor:
+            profile.count('rows.consts')
             for c in r[:-1]:
                 if isinstance(c, str) and c != '':
                     k = c
@@ -224,14 +867,742 @@ ORDER BY {value}
         return result
 
 
-def main(config=None):
-    local = Path(os.path.realpath(os.path.dirname(__file__)))
+def const_queries(tables, settings):
+    """Yield the table, key columns and value column of every constant to load"""
+    extract_field = settings['extract_field']
 
-    # load configuration
-    config = local / ('generator.ini' if config is None else config)
-    if not config.exists():
-        raise Exception('Unable to load configuration %s', config)
+    for table, value in settings['extract_const'].items():
+        if table in tables and table_selected(table, settings):
+            if table in extract_field:
+                keys = [extract_field[table]]
+            else:
+                keys = [cfield for cfield in settings['const_fields'] if cfield in tables[table].columns]
+
+            if keys:
+                yield table, keys, value
+
+
+def load_consts(cnx, tables, settings, schema=None):
+    table_consts = {}
+    for table, keys, value in const_queries(tables, settings):
+        table_consts[table] = load_const(cnx, table if schema is None else '%s.%s' % (schema, table), keys, value)
+
+    return table_consts
+
+
+def load_indexes(cnx, tables, names=None):
+    """Load the indexes of the tables, only those of the named tables when given"""
+    sql = statistics_sql
+    if names:
+        sql += '  AND TABLE_NAME IN (%s)\n' % ', '.join(['%s'] * len(names))
+
+    with closing(cnx.cursor()) as cursor:
+        cursor.execute(sql, list(names) if names else None)
+        rows = cursor.fetchall()
+
+    profile.count('rows.indexes', len(rows))
+    build_indexes(tables, rows, names)
+
+
+def load_metadata(cnx, settings):
+    """Load the table definitions, their relations and the configured constants over a single connection"""
+    # relations come first, tables outside the selection they point to are loaded along with the selection
+    _log.info('loading table relation')
+    with profile.stage('load_relation'):
+        relations = load_relation(cnx, settings)
+
+    _log.info('loading table definition')
+    with profile.stage('table_definition'):
+        tables = table_definition(cnx, settings, related_tables(relations, settings))
+        build_relation(tables, relations, settings['ignore'])
+
+    if loads_indexes(settings):
+        with profile.stage('load_indexes'):
+            load_indexes(cnx, tables)
+
+    if loads_table_rows(settings):
+        with profile.stage('table_rows'), closing(cnx.cursor()) as cursor:
+            cursor.execute(table_rows_sql)
+            build_table_rows(tables, cursor.fetchall())
+
+    with profile.stage('load_consts'):
+        table_consts = load_consts(cnx, tables, settings)
+
+    return tables, table_consts
+
+
+def load_metadata_pooled(settings):
+    """
+    Same as load_metadata, but the column scan, the relation scan and the constant queries run concurrently,
+    each worker thread of the pool lazily opening its own connection
+    """
+    connections = []
+    lock = threading.Lock()
+    thread = threading.local()
+
+    def thread_connection():
+        cnx = getattr(thread, 'cnx', None)
+        if cnx is None:
+            cnx = thread.cnx = connection.MySQLConnection(**settings['db'])
+            with lock:
+                connections.append(cnx)
+
+        return cnx
+
+    def fetch(stage, sql, params):
+        with profile.stage(stage), closing(thread_connection().cursor()) as cursor:
+            cursor.execute(sql, params)
+            rows = cursor.fetchall()
+
+        profile.count('rows.%s' % stage, len(rows))
+
+        return rows
+
+    def const(table, keys, value):
+        with profile.stage('load_consts'):
+            return load_const(thread_connection(), table, keys, value)
+
+    try:
+        with ThreadPoolExecutor(max_workers=settings['pool_size']) as executor:
+            _log.info('loading table definition and relation')
+            relations = executor.submit(fetch, 'relations', *relation_query(settings))
+
+            # with an include filter, the column scan needs the tables on the other side of the relations
+            if settings['include']:
+                related = related_tables(relations.result(), settings)
+                columns = executor.submit(fetch, 'columns', *columns_query(settings, related))
+            else:
+                columns = executor.submit(fetch, 'columns', *columns_query(settings))
+
+            indexes = executor.submit(fetch, 'indexes', statistics_sql, None) if loads_indexes(settings) else None
+            table_rows = None
+            if loads_table_rows(settings):
+                table_rows = executor.submit(fetch, 'table_rows', table_rows_sql, None)
+
+            tables = build_tables(columns.result(), settings)
+
+            # constant keys depend on the table columns, the relation scan may still be running
+            _log.info('loading constants')
+            consts = [(table, executor.submit(const, table, keys, value))
+                      for table, keys, value in const_queries(tables, settings)]
+
+            build_relation(tables, relations.result(), settings['ignore'])
+
+            if indexes is not None:
+                build_indexes(tables, indexes.result())
+
+            if table_rows is not None:
+                build_table_rows(tables, table_rows.result())
+
+            table_consts = {table: future.result() for table, future in consts}
+
+    finally:
+        for cnx in connections:
+            cnx.close()
+
+    return tables, table_consts
+
+
+def schema_stub(properties, namespace):
+    """Table standing for a table of another schema, carrying the namespace of its model"""
+    stub = Table(properties.name)
+    stub.namespace = namespace
+    stub.key = properties.key
+
+    return stub
+
+
+def load_schemas(cnx, settings):
+    """
+    Load the metadata of every configured schema over a single connection, each INFORMATION_SCHEMA table scanned
+    once for all of them. A foreign key between two schemas is seen from each side through a stub of the other
+    table, keyed by its schema and name. Return the tables and constants by schema
+    """
+    schemas = list(settings['schemas'])
+
+    _log.info('loading table relation of %d schemas', len(schemas))
+    with profile.stage('load_relation'), closing(cnx.cursor()) as cursor:
+        cursor.execute(*in_schemas(*relation_query(settings), schemas, columns='TABLE_SCHEMA, REFERENCED_TABLE_SCHEMA'))
+        relations = cursor.fetchall()
+
+    profile.count('rows.relations', len(relations))
+
+    _log.info('loading table definition of %d schemas', len(schemas))
+    columns = defaultdict(list)
+    with profile.stage('table_definition'), closing(cnx.cursor()) as cursor:
+        related = related_tables([row[2:] for row in relations], settings)
+        cursor.execute(*in_schemas(*columns_query(settings, related), schemas))
+        for row in cursor:
+            columns[row[0]].append(row[1:])
+
+    tables = {schema: build_tables(columns[schema], settings) for schema in schemas}
+
+    rows = defaultdict(list)
+    for schema, ref_schema, table, column, ref_table, ref_column in relations:
+        if schema == ref_schema:
+            rows[schema].append((table, column, ref_table, ref_column))
+            continue
+
+        if table not in tables[schema] or ref_table not in tables[ref_schema]:
+            continue
+
+        child = '%s.%s' % (schema, table)
+        parent = '%s.%s' % (ref_schema, ref_table)
+        if parent not in tables[schema]:
+            tables[schema][parent] = schema_stub(
+                tables[ref_schema][ref_table], settings['schemas'][ref_schema]['namespace'])
+        if child not in tables[ref_schema]:
+            tables[ref_schema][child] = schema_stub(
+                tables[schema][table], settings['schemas'][schema]['namespace'])
+
+        rows[schema].append((table, column, parent, ref_column))
+        rows[ref_schema].append((child, column, ref_table, ref_column))
+
+    for schema in schemas:
+        build_relation(tables[schema], rows[schema], settings['ignore'])
+
+    if loads_indexes(settings):
+        indexes = defaultdict(list)
+        with profile.stage('load_indexes'), closing(cnx.cursor()) as cursor:
+            cursor.execute(*in_schemas(statistics_sql, None, schemas))
+            for row in cursor:
+                indexes[row[0]].append(row[1:])
+
+        for schema in schemas:
+            own = [table for table, properties in tables[schema].items() if properties.namespace is None]
+            build_indexes(tables[schema], indexes[schema], own)
+
+    if loads_table_rows(settings):
+        table_rows = defaultdict(list)
+        with profile.stage('table_rows'), closing(cnx.cursor()) as cursor:
+            cursor.execute(*in_schemas(table_rows_sql, None, schemas))
+            for row in cursor:
+                table_rows[row[0]].append(row[1:])
+
+        for schema in schemas:
+            build_table_rows(tables[schema], table_rows[schema])
+
+    result = {}
+    for schema in schemas:
+        with profile.stage('load_consts'):
+            result[schema] = tables[schema], load_consts(cnx, tables[schema], settings, schema)
+
+    return result
+
+
+def table_components(names, relations, history_suffix):
+    """
+    Group the tables connected by foreign keys, a history table going with its table. Components are sorted by
+    their first table name
+    """
+    parent = {name: name for name in names}
+
+    def find(name):
+        while parent[name] != name:
+            parent[name] = parent[parent[name]]
+            name = parent[name]
+
+        return name
+
+    def union(a, b):
+        if a in parent and b in parent:
+            a, b = find(a), find(b)
+            if a != b:
+                parent[max(a, b)] = min(a, b)
+
+    for row in relations:
+        union(row[0], row[2])
+
+    if history_suffix:
+        for name in names:
+            union(name, name + history_suffix)
+
+    components = defaultdict(list)
+    for name in sorted(names):
+        components[find(name)].append(name)
+
+    return sorted(components.values())
+
+
+def table_batches(components, size):
+    """Pack whole components into batches of about size tables, components bigger than that are split"""
+    batch = []
+    for component in components:
+        for i in range(0, len(component), size):
+            batch.extend(component[i:i + size])
+            if len(batch) >= size:
+                yield batch
+                batch = []
+
+    if batch:
+        yield batch
+
+
+def stream_metadata(cnx, settings, size):
+    """
+    Yield the table definitions, relations and constants batch after batch of about size tables, each batch
+    made of whole foreign key connected components when possible. Tables of other batches on the other side of
+    a relation, or history tables, only come as a Table with its key, all rendering needs from them
+    """
+    ignore = settings['ignore']
+    include = settings['include']
+    history_suffix = settings['history_suffix']
+
+    _log.info('loading table relation')
+    with profile.stage('load_relation'):
+        relations = load_relation(cnx, settings)
+
+    _log.info('loading table names and keys')
+    with profile.stage('table_names'), closing(cnx.cursor()) as cursor:
+        cursor.execute(tables_sql)
+        names = [row[0] for row in cursor]
+
+        keys = {}
+        cursor.execute(keys_sql)
+        for table, column in cursor:
+            keys[table] = column
+
+        # row counts of the whole schema, the audit compares both sides of a relation
+        table_rows = {}
+        if loads_table_rows(settings):
+            cursor.execute(table_rows_sql)
+            table_rows = {table: (rows, size) for table, rows, size in cursor}
+
+    # the same tables as the column scan of load_metadata
+    related = related_tables(relations, settings)
+    history = [pattern + history_suffix for pattern in include or ['*']] if history_suffix else []
+    if include or ignore:
+        names = [name for name in names if table_selected(name, settings) or name in related or
+                 (history and table_matches(name, history))]
+
+    known = set(names)
+
+    # relation rows by table on either side, in their original order
+    table_relations = defaultdict(list)
+    for i, row in enumerate(relations):
+        table_relations[row[0]].append(i)
+        if row[2] != row[0]:
+            table_relations[row[2]].append(i)
 
+    for batch in table_batches(table_components(names, relations, history_suffix), size):
+        with profile.stage('table_definition'), closing(cnx.cursor()) as cursor:
+            cursor.execute('%s  AND TABLE_NAME IN (%s)\nORDER BY TABLE_NAME, ORDINAL_POSITION\n' % (
+                columns_sql, ', '.join(['%s'] * len(batch))), batch)
+            tables = build_tables(cursor, settings)
+
+        if profile.enabled:
+            profile.count('rows.columns', sum(len(properties.columns) for properties in tables.values()))
+
+        rows = [relations[i] for i in sorted({i for table in batch for i in table_relations.get(table, [])})]
+
+        others = {table for row in rows for table in (row[0], row[2])}
+        if history_suffix:
+            others.update(table + history_suffix for table in batch)
+
+        for table in others.intersection(known).difference(tables):
+            properties = tables[table] = Table(table)
+            properties.key = keys.get(table, 'id')
+
+        build_relation(tables, rows, ignore)
+
+        batch = [table for table in batch if table in tables]
+
+        if loads_indexes(settings) and batch:
+            with profile.stage('load_indexes'):
+                load_indexes(cnx, tables, batch)
+
+        if table_rows:
+            build_table_rows(tables, ((table,) + table_rows[table] for table in tables if table in table_rows))
+
+        with profile.stage('load_consts'):
+            table_consts = load_consts(cnx, {table: tables[table] for table in batch}, settings)
+
+        yield tables, table_consts, batch
+
+
+def write_snapshot(cnx, settings, path):
+    """
+    Dump the table definitions, their relations and the configured constants into a JSON lines file (gzip
+    compressed when the path ends with .gz): a header line then one line per table
+    """
+    relation_rows = load_relation(cnx, settings)
+    relations = defaultdict(list)
+    for row in relation_rows:
+        relations[row[0]].append(row[1:])
+
+    with closing(cnx.cursor()) as cursor:
+        cursor.execute(*columns_query(settings, related_tables(relation_rows, settings)))
+        columns = defaultdict(list)
+        for row in cursor:
+            columns[row[0]].append(row[1:])
+
+    tables = build_tables(((table,) + row for table, rows in columns.items() for row in rows), settings)
+    table_consts = load_consts(cnx, tables, settings)
+
+    indexes = defaultdict(list)
+    with closing(cnx.cursor()) as cursor:
+        cursor.execute(statistics_sql)
+        for row in cursor:
+            indexes[row[0]].append(row[1:])
+
+        cursor.execute(table_rows_sql)
+        table_rows = {table: (rows, size) for table, rows, size in cursor}
+
+    header = {
+        'format': snapshot_format,
+        'version': snapshot_version,
+        'database': settings['db'].get('database'),
+        'state': schema_state(cnx, settings),
+    }
+
+    with open_snapshot(path, 'wt') as fd:
+        fd.write(json.dumps(header) + '\n')
+        for table, rows in columns.items():
+            fd.write(json.dumps({
+                'table': table,
+                'columns': rows,
+                'relations': relations.get(table, []),
+                'consts': table_consts.get(table),
+                'indexes': indexes.get(table, []),
+                'rows': table_rows.get(table, (None, None))[0],
+                'size': table_rows.get(table, (None, None))[1],
+            }, default=str) + '\n')
+
+    return header
+
+
+def read_snapshot(path, settings):
+    """Load a snapshot written by write_snapshot, return the tables, their constants and the schema state"""
+    profile.count('bytes_read', path.stat().st_size)
+
+    with open_snapshot(path, 'rt') as fd:
+        header = json.loads(fd.readline() or '{}')
+        # version 1 snapshots have no indexes, version 1 and 2 no column default
+        if header.get('format') != snapshot_format or header.get('version') not in [1, 2, snapshot_version]:
+            raise Exception('Unsupported snapshot %s' % path)
+
+        columns = []
+        relations = []
+        indexes = []
+        table_rows = []
+        table_consts = {}
+        for line in fd:
+            data = json.loads(line)
+            table = data['table']
+
+            columns.extend([table] + row + [None] * (6 - len(row)) for row in data['columns'])
+            relations.extend([table] + row for row in data['relations'])
+            indexes.extend([table] + row for row in data.get('indexes', []))
+            table_rows.append((table, data.get('rows'), data.get('size')))
+            if data['consts'] is not None:
+                table_consts[table] = data['consts']
+
+    tables = build_tables(columns, settings)
+    build_relation(tables, relations, settings['ignore'])
+    build_indexes(tables, indexes, None if header['version'] > 1 else [])
+    build_table_rows(tables, table_rows)
+
+    return tables, table_consts, header['state']
+
+
+def open_snapshot(path, mode):
+    if path.suffix == '.gz':
+        return gzip.open(str(path), mode, encoding='utf-8')
+
+    return path.open(mode[0], encoding='utf-8')
+
+
+def fingerprint(data):
+    return hashlib.sha1(json.dumps(data, default=str).encode('utf-8')).hexdigest()
+
+
+def schema_state(cnx, settings, schemas=None):
+    """
+    Cheap summary of every table in the schema, used to detect that nothing changed since the last run
+    without loading the whole INFORMATION_SCHEMA.COLUMNS, the indexes included when the models depend on them
+    and whether the table is past the bulk thresholds, not its row count which changes all the time. The small
+    constant tables are checksummed, their rows being rendered into the models. With a list of schemas, the
+    summary of each of them by schema
+    """
+    state = {}
+    with closing(cnx.cursor()) as cursor:
+        def execute(sql, columns='TABLE_SCHEMA'):
+            """Rows of the query, keyed by schema and table when there are several schemas"""
+            if not schemas:
+                cursor.execute(sql)
+                return cursor
+
+            cursor.execute(*in_schemas(sql, None, schemas, columns))
+            return (((row[0], row[1]),) + tuple(row[2:]) for row in cursor)
+
+        rows = execute('''\
+SELECT t.TABLE_NAME, t.CREATE_TIME, t.UPDATE_TIME, COUNT(c.COLUMN_NAME),
+       SUM(CRC32(CONCAT_WS(',', c.COLUMN_NAME, c.COLUMN_KEY, c.IS_NULLABLE, c.COLUMN_TYPE, c.EXTRA,
+                             c.COLUMN_DEFAULT, c.GENERATION_EXPRESSION)))
+FROM INFORMATION_SCHEMA.TABLES t
+LEFT JOIN INFORMATION_SCHEMA.COLUMNS c ON c.TABLE_SCHEMA = t.TABLE_SCHEMA AND c.TABLE_NAME = t.TABLE_NAME
+WHERE t.TABLE_SCHEMA = DATABASE()
+GROUP BY t.TABLE_NAME, t.CREATE_TIME, t.UPDATE_TIME
+''', 't.TABLE_SCHEMA')
+
+        for table, created, updated, count, checksum in rows:
+            state[table] = '%s|%s|%s|%s' % (created, updated, count, checksum)
+
+        profile.count('rows.schema_state', len(state))
+
+        rows = execute('''\
+SELECT TABLE_NAME, COUNT(*)
+FROM INFORMATION_SCHEMA.KEY_COLUMN_USAGE
+WHERE TABLE_SCHEMA = DATABASE()
+  AND REFERENCED_TABLE_NAME IS NOT NULL
+GROUP BY TABLE_NAME
+''')
+
+        for table, count in rows:
+            state[table] = '%s|%s' % (state.get(table), count)
+
+        if uses_indexes(settings):
+            rows = execute('''\
+SELECT TABLE_NAME, COUNT(*), SUM(CRC32(CONCAT_WS(',', INDEX_NAME, SEQ_IN_INDEX, COLUMN_NAME)))
+FROM INFORMATION_SCHEMA.STATISTICS
+WHERE TABLE_SCHEMA = DATABASE()
+GROUP BY TABLE_NAME
+''')
+
+            for table, count, checksum in rows:
+                state[table] = '%s|%s|%s' % (state.get(table), count, checksum)
+
+        if settings['bulk_table_rows'] or settings['bulk_table_size']:
+            for table, count, size in execute(table_rows_sql):
+                state[table] = '%s|%s' % (state.get(table), bulk_table(count, size, settings))
+
+        # the rows of the constant tables, their UPDATE_TIME being cached or lost on a restart
+        consts = sorted(key for key in state if (key[1] if schemas else key) in settings['extract_const']
+                        and table_selected(key[1] if schemas else key, settings))
+
+        if consts:
+            cursor.execute('CHECKSUM TABLE %s' % ', '.join(
+                '.'.join(quote_name(name) for name in (key if schemas else (key,))) for key in consts))
+            for name, checksum in cursor.fetchall():
+                schema, table = name.split('.', 1)
+                key = (schema, table) if schemas else table
+                if key in state:
+                    state[key] = '%s|%s' % (state[key], checksum)
+
+    if schemas:
+        states = {schema: {} for schema in schemas}
+        for (schema, table), value in state.items():
+            states[schema][table] = value
+
+        return states
+
+    return state
+
+
+def reference_state(path):
+    try:
+        stat = path.stat()
+    except OSError:
+        return None
+
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def settings_slice(settings):
+    """Part of the settings shared by every table"""
+    return [
+        str(settings['path_model']),
+        settings['path_ref'],
+        settings['db'].get('host'),
+        settings['db'].get('port'),
+        settings['db'].get('database'),
+        settings['namespace'],
+        settings['include'],
+        settings['ignore'],
+        settings['hidden_column'],
+        settings['history_suffix'],
+        settings['history_mode'],
+        settings['always_add_region'],
+        settings['index_scope'],
+        settings['unindexed_where'],
+        settings['unindexed_warning'],
+        settings['bulk_table_rows'],
+        settings['bulk_table_size'],
+        settings['eager_load'].get(None),
+        settings['lazy_loading_guard'],
+        settings['lazy_loading_environments'],
+        settings['base_class'],
+        settings['base_namespace'],
+        settings['shared_base_class'],
+        str(settings['preload_path']),
+        settings['preload_autoload'],
+        settings['casts_fields'].get(None),
+        sorted(settings['irregular'].items()),
+        sorted(settings['uncountable']),
+        settings['additional_docblock'],
+        settings['const_fields'],
+        settings['extract_const'],
+        settings['extract_field'],
+        settings['const_cache'],
+        settings['const_cache_ttl'],
+        settings['const_cache_tag'],
+    ]
+
+
+def table_settings(settings, table):
+    """Part of the settings specific to a table"""
+    return [
+        settings[name].get(table) for name in [
+            'base_classes',
+            'casts_fields',
+            'hidden_columns',
+            'additional_properties',
+            'additional_children',
+            'additional_parents',
+            'additional_methods',
+            'eager_load',
+        ]
+    ]
+
+
+def table_fingerprint(table, tables, table_consts, settings, reference):
+    """
+    Digest of everything the model of a table is rendered from: its columns, the key and name of the tables
+    on both side of its relations, its constants, its slice of the settings and its reference file
+    """
+    properties = tables[table]
+
+    relations = []
+    for side in ['parent', 'child']:
+        for ref_table, columns in getattr(properties, side).items():
+            relations.append([
+                side,
+                ref_table,
+                tables[ref_table].key,
+                tables[ref_table].model,
+                tables[ref_table].namespace,
+                [[column, foreign_key.ref_column] for column, foreign_key in columns.items()],
+            ])
+
+    history_suffix = settings['history_suffix']
+
+    return fingerprint([
+        properties.model,
+        properties.key,
+        properties.primary,
+        properties.autoincrement,
+        properties.timestamps,
+        [[column, definition.type] for column, definition in properties.columns.items()],
+        properties.defaults,
+        properties.computed,
+        properties.fillable,
+        sorted(properties.date),
+        sorted(properties.nullable),
+        sorted(properties.hidden),
+        relations,
+        properties.indexes,
+        bulk_table(properties.rows, properties.size, settings),
+        bool(history_suffix) and (table + history_suffix) in tables,
+        table_consts.get(table),
+        table_settings(settings, table),
+        reference,
+    ])
+
+
+def settings_fingerprint(settings, templates):
+    """Digest of the settings and templates every model depends on, a cache made with others is ignored"""
+    return fingerprint([
+        cache_version,
+        settings_slice(settings),
+        sorted((name, template.text) for name, template in templates.items()),
+    ])
+
+
+def load_cache(path, settings_digest):
+    """
+    Previous run fingerprints, None when made with other settings, and the parsed reference regions which don't
+    depend on the settings
+    """
+    if path is None or not path.exists():
+        return None, {}
+
+    try:
+        cache = json.loads(path.read_text())
+    except ValueError:
+        _log.warning('ignoring unreadable cache %s', path)
+        return None, {}
+
+    if cache.get('version') != cache_version:
+        return None, {}
+
+    regions = cache.pop('regions', {})
+    if cache.get('settings') != settings_digest:
+        return None, regions
+
+    return cache, regions
+
+
+def save_cache(path, cache):
+    if path is None:
+        return
+
+    tmp = path.with_name(path.name + '.tmp')
+    tmp.write_text(json.dumps(cache))
+    os.replace(str(tmp), str(path))
+
+
+def load_manifest(path, path_model):
+    """Content hash, size and modification time of every model written by the previous runs, by file name"""
+    if path is None or not path.exists():
+        return {}
+
+    try:
+        manifest = json.loads(path.read_text())
+    except ValueError:
+        _log.warning('ignoring unreadable manifest %s', path)
+        return {}
+
+    if manifest.get('version') != manifest_version or manifest.get('path') != str(path_model):
+        return {}
+
+    return manifest['files']
+
+
+def save_manifest(path, path_model, files):
+    if path is None:
+        return
+
+    tmp = path.with_name(path.name + '.tmp')
+    tmp.write_text(json.dumps({'version': manifest_version, 'path': str(path_model), 'files': files}))
+    os.replace(str(tmp), str(path))
+
+
+def cache_is_fresh(cache, state, path_model):
+    """Whether the previous run was made against the same schema, references and outputs"""
+    if cache is None or cache['state'] != state:
+        return False
+
+    for path, stat in cache['references'].items():
+        if reference_state(Path(path)) != stat:
+            return False
+
+    for name in cache['files']:
+        if not (path_model / name).is_file():
+            return False
+
+    return True
+
+
+def name_list(value):
+    """Names of a list setting, a string standing for its comma or space separated names"""
+    if isinstance(value, str):
+        return value.replace(',', ' ').split()
+
+    return list(value or [])
+
+
+def load_config(config):
+    """Read a generator.ini / generator.yaml file into a plain settings dict."""
     base_classes = {}
     casts_fields = defaultdict(dict)
 
@@ -241,12 +1612,22 @@ def main(config=None):
     additional_parents = defaultdict(dict)
     additional_methods = {}
 
-    additional_docblock = defaultdict(lambda: defaultdict(dict))
+    additional_docblock = defaultdict(dict)
 
     const_fields = []
     extract_const = {}
     extract_field = {}
 
+    irregular = {}
+    eager_load = {}
+
+    const_cache = False
+    cache_ttl = const_cache_ttl
+    cache_tag = const_cache_tag
+
+    audit = {}
+    schemas = {}
+
     if config.suffix in ['.yaml', '.yml']:
         conf = yaml.safe_load(config.open())
 
@@ -255,10 +1636,27 @@ def main(config=None):
         db = conf['db']
 
         namespace = conf['model'].get('namespace', 'App')
+        include = conf['options'].get('included_table', [])
         ignore = conf['options'].get('ignored_table', [])
         hidden_column = conf['model'].get('property', {}).get('hidden', [])
         history_suffix = conf['model'].get('history_suffix', '')
+        history_mode = conf['model'].get('history_mode', 'instance')
+        shared_base_class = conf['model'].get('shared_base_class')
+        preload_path = conf['options'].get('preload_path')
+        preload_autoload = conf['options'].get('preload_autoload')
         always_add_region = conf['options'].get('always_add_region', False)
+        index_scope = conf['options'].get('index_scope', False)
+        unindexed_where = conf['options'].get('unindexed_where') or ''
+        unindexed_text = conf['options'].get('unindexed_warning', unindexed_warning)
+        bulk_table_rows = conf['options'].get('bulk_table_rows')
+        bulk_table_size = conf['options'].get('bulk_table_size')
+        cache_path = conf['options'].get('cache_path', config.with_name(config.name + '.cache'))
+        manifest_path = conf['options'].get('manifest_path', config.with_name(config.name + '.manifest'))
+        lazy_loading_guard = conf['options'].get('lazy_loading_guard', False)
+        lazy_loading_environments = conf['options'].get('lazy_loading_environments', ['production'])
+
+        if 'eager_load' in conf['model']:
+            eager_load[None] = name_list(conf['model']['eager_load'])
 
         base_class = base_namespace = conf['model'].get('base_class', 'Eloquent')
         if ' as ' in base_class:
@@ -270,6 +1668,18 @@ def main(config=None):
             const_fields = conf['constant'].get('default_value_column', [])
             extract_const = conf['constant'].get('key_column', {})
             extract_field = conf['constant'].get('value_column', {})
+            const_cache = conf['constant'].get('cache', False)
+            cache_ttl = conf['constant'].get('cache_ttl', const_cache_ttl)
+            cache_tag = conf['constant'].get('cache_tag', const_cache_tag)
+
+        inflection = conf.get('inflection', {})
+        irregular = inflection.get('irregular', {})
+        uncountable = inflection.get('uncountable', [])
+
+        audit = conf.get('audit') or {}
+
+        for schema, options in (conf.get('schemas') or {}).items():
+            schemas[schema] = options or {}
 
         if 'cast' in conf['model'].get('property', {}):
             for key, value in conf['model']['property']['cast'].items():
@@ -292,6 +1702,9 @@ def main(config=None):
             for key, value in property_.get('cast', {}).items():
                 casts_fields[model][key] = value
 
+            if 'eager_load' in override:
+                eager_load[model] = name_list(override['eager_load'])
+
             additionals = override.get('additional', {})
             for key, value in additionals.get('children', {}).items():
                 additional_children[model][key] = value
@@ -310,6 +1723,7 @@ def main(config=None):
                 additional_docblock[key][subkey] = subvalue
 
         path_ref = conf['options'].get('reference_path')
+        path_template = conf['options'].get('template_path')
 
     else:
         conf = ConfigParser()
@@ -323,10 +1737,32 @@ def main(config=None):
         db = conf['db']
 
         namespace = conf['options'].get('namespace', 'App')
+        include = [x for x in map(str.strip, conf['options'].get('included_table', '').splitlines()) if x]
         ignore = [x for x in map(str.strip, conf['options'].get('ignored_table', []).splitlines()) if x]
         hidden_column = [x for x in map(str.strip, conf['options'].get('hidden_column', []).splitlines()) if x]
         history_suffix = conf['options'].get('history_table_suffix')
+        history_mode = conf['options'].get('history_mode', 'instance').strip().lower()
+        shared_base_class = conf['options'].get('shared_base_class')
+        preload_path = conf['options'].get('preload_path')
+        preload_autoload = conf['options'].get('preload_autoload')
         always_add_region = conf['options'].get('always_add_region', 'false').lower() in ['true', 'yes', 't', 'y', '1']
+        index_scope = conf['options'].get('index_scope', 'false').lower() in ['true', 'yes', 't', 'y', '1']
+        unindexed_where = conf['options'].get('unindexed_where', '').strip().lower()
+        unindexed_text = conf['options'].get('unindexed_warning', unindexed_warning)
+        bulk_table_rows = conf['options'].get('bulk_table_rows', '').strip()
+        bulk_table_size = conf['options'].get('bulk_table_size', '').strip()
+        cache_path = conf['options'].get('cache_path', config.with_name(config.name + '.cache'))
+        manifest_path = conf['options'].get('manifest_path', config.with_name(config.name + '.manifest'))
+        lazy_loading_guard = conf['options'].get('lazy_loading_guard', 'false').lower() in [
+            'true', 'yes', 't', 'y', '1']
+        lazy_loading_environments = conf['options'].get('lazy_loading_environments', 'production').split()
+
+        if 'eager_load' in conf['options']:
+            eager_load[None] = name_list(conf['options']['eager_load'])
+
+        if conf.has_section('eager_load'):
+            for name, value in conf.items('eager_load'):
+                eager_load[name] = name_list(value)
 
         base_class = base_namespace = conf.get('options', 'base_class', fallback='Eloquent')
         if ' as ' in base_class:
@@ -347,6 +1783,21 @@ def main(config=None):
             const_fields = [x for x in map(str.strip, conf['constant']['default_value_column'].splitlines()) if x]
             extract_const = conf['constant/key_column']
             extract_field = conf['constant/value_column']
+            const_cache = conf['constant'].get('cache', 'false').lower() in ['true', 'yes', 't', 'y', '1']
+            cache_ttl = conf['constant'].get('cache_ttl', const_cache_ttl)
+            cache_tag = conf['constant'].get('cache_tag', const_cache_tag)
+
+        if conf.has_section('inflection/irregular'):
+            irregular = dict(conf.items('inflection/irregular'))
+
+        uncountable = [x for x in map(str.strip, conf.get('inflection', 'uncountable', fallback='').splitlines()) if x]
+
+        if conf.has_section('audit'):
+            audit = dict(conf.items('audit'))
+
+        for section in conf.sections():
+            if section.startswith('schema/'):
+                schemas[section[len('schema/'):]] = dict(conf.items(section))
 
         if conf.has_section('cast'):
             for key, value in conf.items('cast'):
@@ -357,457 +1808,2008 @@ def main(config=None):
                     casts_fields[None][key] = value
 
         path_ref = conf['options'].get('reference_path')
+        path_template = conf['options'].get('template_path')
 
     base_class.strip()
     base_namespace.strip()
 
-    if not path_model.exists():
-        path_model.mkdir(parents=True)
+    if history_mode not in history_templates:
+        raise Exception('Unsupported history_mode "%s", use %s' % (history_mode, ', '.join(history_templates)))
+
+    if unindexed_where not in unindexed_where_modes:
+        raise Exception('Unsupported unindexed_where "%s", use warn or drop' % unindexed_where)
+
+    # the models of each schema default to a sub directory and a sub namespace named after it
+    for schema, options in schemas.items():
+        schemas[schema] = {
+            'namespace': options.get('namespace') or '%s\\%s' % (namespace, camelize(schema)),
+            'path_model': Path(options.get('result_path') or path_model / schema),
+            'path_ref': options.get('reference_path') or (str(Path(path_ref) / schema) if path_ref else None),
+            'preload_path': Path(options['preload_path']) if options.get('preload_path') else None,
+        }
+
+    # not a connection argument, number of connections loading the metadata concurrently
+    db = dict(db)
+    pool_size = int(db.pop('pool_size', 1))
+
+    return {
+        'path_model': path_model,
+        'path_ref': path_ref,
+        'path_template': Path(path_template) if path_template else local / 'template',
+        'cache_path': Path(cache_path) if cache_path else None,
+        'manifest_path': Path(manifest_path) if manifest_path else None,
+        'preload_path': Path(preload_path) if preload_path else None,
+        'preload_autoload': preload_autoload,
+        'db': db,
+        'pool_size': pool_size,
+        'schemas': schemas,
+        'namespace': namespace,
+        'include': include,
+        'ignore': ignore,
+        'hidden_column': hidden_column,
+        'history_suffix': history_suffix,
+        'history_mode': history_mode,
+        'always_add_region': always_add_region,
+        'index_scope': index_scope,
+        'unindexed_where': unindexed_where,
+        'unindexed_warning': unindexed_text,
+        # empty thresholds disable the bulk helpers, the size is in MB of data
+        'bulk_table_rows': int(bulk_table_rows) if bulk_table_rows else None,
+        'bulk_table_size': int(bulk_table_size) if bulk_table_size else None,
+        'base_class': base_class,
+        'base_namespace': base_namespace,
+        'base_classes': base_classes,
+        'shared_base_class': shared_base_class or None,
+        'casts_fields': dict(casts_fields),
+        'cast_rules': cast_rules(casts_fields),
+        'irregular': irregular,
+        'uncountable': uncountable,
+        'inflector': Inflector(irregular, uncountable),
+        'hidden_columns': dict(hidden_columns),
+        'additional_properties': dict(additional_properties),
+        'additional_children': dict(additional_children),
+        'additional_parents': dict(additional_parents),
+        'additional_methods': additional_methods,
+        'additional_docblock': dict(additional_docblock),
+        'eager_load': eager_load,
+        'lazy_loading_guard': lazy_loading_guard,
+        'lazy_loading_environments': lazy_loading_environments,
+        'const_fields': const_fields,
+        'extract_const': dict(extract_const),
+        'extract_field': dict(extract_field),
+        'const_cache': const_cache,
+        'const_cache_ttl': int(cache_ttl),
+        'const_cache_tag': cache_tag,
+        # set by generate when an audit report is requested
+        'audit': False,
+        'audit_table_rows': int(audit.get('large_table_rows', audit_table_rows)),
+        'audit_fan_out': float(audit.get('fan_out', audit_fan_out)),
+    }
+
+
+template_names = ['history', 'history_boot', 'history_batch', 'one_to_one', 'one_to_many', 'many_to_one', 'scope',
+                  'eager_load', 'lazy_loading', 'const_cache', 'booted', 'model', 'model_compact', 'model_base',
+                  'attributes', 'preload', 'bulk']
+
+# template of each history_mode, boot registers the transaction listener once per model class instead of once per
+# instance, batch also collects the revisions of a transaction into a single insert right before its commit
+history_templates = {
+    'instance': 'history',
+    'boot': 'history_boot',
+    'batch': 'history_batch',
+}
 
-    elif not path_model.is_dir():
-        raise Exception('Unable to use "%s" as path_model', path_model)
 
-    path_template = local / 'template'
+class Template(object):
+    """
+    str.format template parsed once into its literal segments and fields. partial() substitutes some of the
+    fields and caches the resulting template, so repeated relation snippets are only assembled once
+    """
+    __slots__ = ['text', 'parts', 'fields', 'partials']
+
+    formatter = string.Formatter()
+
+    def __init__(self, text, segments=None):
+        self.text = text
+
+        if segments is None:
+            segments = []
+            for literal, field, spec, conversion in self.formatter.parse(text):
+                if literal:
+                    segments.append(literal)
+
+                if field is not None:
+                    if not field.isidentifier():
+                        raise ValueError('Unsupported template field {%s}' % field)
+
+                    segments.append((field, spec, conversion))
+
+        # adjacent literals, once fields are substituted by partial(), are merged
+        self.parts = []
+        self.fields = []
+        literal = False
+        for segment in segments:
+            if not isinstance(segment, str):
+                self.fields.append((len(self.parts), segment))
+                self.parts.append('')
+                literal = False
+            elif literal:
+                self.parts[-1] += segment
+            else:
+                self.parts.append(segment)
+                literal = True
 
-    existing_models = []
-    for f in path_model.iterdir():
-        if f.is_file():
-            existing_models.append(f)
+        self.partials = {}
 
-    template_history = (path_template / 'history.txt').read_text()
-    template_one_to_one = (path_template / 'one_to_one.txt').read_text()
-    template_one_to_many = (path_template / 'one_to_many.txt').read_text()
-    template_many_to_one = (path_template / 'many_to_one.txt').read_text()
-    template_model = (path_template / 'model.txt').read_text()
+    def value(self, values, field):
+        name, spec, conversion = field
+        value = values[name]
+        if conversion:
+            value = self.formatter.convert_field(value, conversion)
 
-    table_consts = {}
+        if spec or not isinstance(value, str):
+            value = format(value, spec)
 
-    # open connection to database then load table definition, load tabel relation and
-    # value constant if specified
-    _log.info('connection')
-    with closing(connection.MySQLConnection(**db)) as cnx:
-        _log.info('loading table definition')
-        tables = table_definition(cnx)
+        return value
 
-        _log.info('loading table relation')
-        load_relation(cnx, tables, ignore)
+    def render(self, **values):
+        parts = self.parts[:]
+        for index, field in self.fields:
+            parts[index] = self.value(values, field)
 
-        for table, value in extract_const.items():
-            if table in tables:
-                if table in extract_field:
-                    keys = [extract_field[table]]
-                else:
-                    keys = [cfield for cfield in const_fields if cfield in tables[table]['column']]
+        return ''.join(parts)
 
-                if keys:
-                    table_consts[table] = load_const(cnx, table, keys, value)
+    def partial(self, **values):
+        """Template with the given fields already substituted"""
+        key = tuple(sorted(values.items()))
+        template = self.partials.get(key)
+        if template is None:
+            segments = list(self.parts)
+            for index, field in self.fields:
+                segments[index] = self.value(values, field) if field[0] in values else field
 
-    for table, properties in tables.items():
-        if table in ignore:
-            continue
+            template = self.partials[key] = Template(self.text, segments)
 
-        _log.info('processing table %s', table)
+        return template
 
-        key = properties['key']
-        name = properties['name']
 
-        key_full = '%s_id' % table if key == 'id' else key
+def load_templates(path_template, path_default=None):
+    """Compile the templates, those missing from path_template are taken from path_default"""
+    templates = {}
+    for name in template_names:
+        f = path_template / ('%s.txt' % name)
+        if path_default is not None and not f.exists():
+            f = path_default / ('%s.txt' % name)
 
-        use = [
-            'use %s;' % base_namespace,
-            'use Illuminate\\Database\\Eloquent\\Collection;',
-            'use Illuminate\\Database\\Eloquent\\Builder;',
-        ]
+        templates[name] = Template(f.read_text())
 
-        docs = []
-        const = ''
-        hidden = []
-        methods = []
-        fillable = ["        '%s'" % column for column in properties['fillable']]
-        dates = []
-        casts = []
+    return templates
 
-        additional_property = []
 
-        props = []
-        wheres = []
-        relations = []
+_use_blocks = {}
 
-        doc_methods = []
 
-        for field, value in additional_properties.get(table, {}).items():
-            if isinstance(value, list):
-                value = "[\n        '%s'\n    ]" % "',\n        '".join(value)
-            elif isinstance(value, str):
-                value = "'%s'" % value
-            elif isinstance(value, bool):
-                value = '%s' % ('true' if value else 'false')
-            else:
-                value = '%r' % value
+def use_block(use):
+    """Sorted use statements, the same few sets of them come back for most of the models"""
+    key = frozenset(use)
+    block = _use_blocks.get(key)
+    if block is None:
+        block = _use_blocks[key] = '\n'.join(sorted(key))
 
-            docblock = ''
-            if field in additional_docblock['property']:
-                docblock = '\n'
-                for line in additional_docblock['property'][field].splitlines():
-                    docblock += '    %s\n' % line
+    return block
 
-            additional_property.append('%s    protected $%s = %s;\n' % (docblock, field, value))
 
-        # add history related method if table history exists
-        if history_suffix and (table + history_suffix) in tables:
-            methods.append(template_history.format(
-                table=table,
-                key=key,
-                model=name
-            ))
+_references = {}
 
-        if table in table_consts and table_consts[table]:
-            const = ''.join(['\n    ', '\n    '.join(table_consts[table]), '\n'])
+# lines where the state of the reference parser may change, every other line only goes to the current region
+reference_event = re.compile(r'^(?:class[^\n]*|[^\S\n]*//(?:end)?region[^\n]*)$', re.MULTILINE)
 
-        casts_field = casts_fields.get(None, {})
-        if table in casts_fields:
-            casts_field = casts_field.copy()
-            casts_field.update(casts_fields[table])
+# line separators of str.splitlines other than \n and \r\n, the scanner leaves such files to the line parser
+unusual_separator = re.compile('\r(?!\n)|[\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029]')
 
-        column_length = 0
-        type_length = 0
 
-        for column in properties['column']:
-            if column not in properties['date']:
-                column_length = max(column_length, len(column))
+class ReferenceParser(object):
+    """State of the extraction of the user regions, the traits and the class declaration of a reference model"""
+    __slots__ = ['is_namespace', 'is_trait', 'is_function', 'regions', 'traits', 'extends', 'additional_ns',
+                 'additional_function']
 
-        for column, col_type in properties['column'].items():
-            if col_type in [date_type, datetime_type]:
-                use.append('use Carbon\\Carbon;')
-                prop_type = 'Carbon'
-            else:
-                prop_type = col_type
+    def __init__(self):
+        self.is_namespace = False
+        self.is_trait = False
+        self.is_function = False
 
-            method = camelize(column)
+        self.regions = []
+        self.traits = []
+        self.extends = []
+        self.additional_ns = []
+        self.additional_function = []
 
-            if column in properties['null']:
-                prop_type = 'null|' + prop_type
-            type_length = max(type_length, len(prop_type))
+    def line(self, line):
+        line_stripped = line.strip()
 
-            if table in hidden_columns and column in hidden_columns[table]:
-                hidden.append("        '%s'" % column)
-            elif column in hidden_column:
-                hidden.append("        '%s'" % column)
+        if line.startswith('class') and 'extends' in line_stripped:
+            self.is_trait = True
+            lines = line_stripped.split(' ')
+            if len(lines) > 4:
+                self.extends.append(' '.join(lines[4:]))
 
-            props.append((prop_type, column))
+        elif line_stripped.startswith('//region'):
+            region = line_stripped.replace('//region', '').strip()
+            self.regions.append(region)
 
-            wheres.append('@method static Builder|%s where%s($value)' % (name, method))
+            if region == namespace_mark:
+                self.is_namespace = True
+            elif region == function_mark:
+                self.is_function = True
+            elif self.is_namespace:
+                self.additional_ns.append(line)
+            elif self.is_function:
+                self.additional_function.append(line)
+
+        elif line_stripped.startswith('//endregion'):
+            region = self.regions.pop(-1)
+
+            if region == namespace_mark:
+                self.is_namespace = False
+            elif region == function_mark:
+                self.is_function = False
+            elif self.is_namespace:
+                self.additional_ns.append(line)
+            elif self.is_function:
+                self.additional_function.append(line)
+
+        elif self.is_trait:
+            if line_stripped.startswith('use'):
+                self.traits.append(line)
+            elif not line_stripped:
+                self.is_trait = False
 
-            for pat, cast in casts_field.items():
-                if fnmatch(column, pat):
-                    casts.append("        '%s'%s => '%s'" % (column, ' ' * (column_length - len(column)), cast))
+        elif self.is_namespace:
+            self.additional_ns.append(line)
+
+        elif self.is_function:
+            self.additional_function.append(line)
+
+    def block(self, lines):
+        """Lines without any class or region marker, copied as a whole into the open region"""
+        if self.is_trait:
+            for i, line in enumerate(lines):
+                self.line(line)
+                if not self.is_trait:
+                    lines = lines[i + 1:]
                     break
             else:
-                if column in properties['date']:
-                    dates.append("        '%s'" % column)
-                elif column not in ['created_at', 'updated_at']:
-                    casts.append("        '%s'%s => '%s'" % (column, ' ' * (column_length - len(column)), col_type))
-
-        # relation
-        for ref_table, columns in sorted(properties['child'].items()):
-            ref_key = tables[ref_table]['key']
-            ref_name = tables[ref_table]['name']
-
-            for column, ref_column in columns.items():
-                column_full = '%s_id' % table if column == 'id' else column
-
-                if column == ref_key:
-                    ref = ref_name[0].lower() + ref_name[1:]
-                    type_length = max(type_length, len(ref_name) + 5)
-
-                    relations.append((ref_name, ref))
-                    methods.append(template_one_to_one.format(
-                        ref=ref,
-                        namespace=namespace,
-                        model=ref_name,
-                        column=column,
-                        ref_column=ref_column
-                    ))
-                    use.append('use Illuminate\\Database\\Eloquent\\Relations\\HasOne;')
+                return
+
+        if self.is_namespace:
+            self.additional_ns.extend(lines)
+        elif self.is_function:
+            self.additional_function.extend(lines)
+
+    def result(self):
+        return {
+            'extends': self.extends,
+            'traits': self.traits,
+            'namespaces': self.additional_ns,
+            'functions': self.additional_function,
+        }
+
+
+def scan_reference(text):
+    """
+    Extract the regions of a reference model. Only the class and region marker lines, found with a single regex,
+    go through the line parser, the lines between two of them are copied in bulk
+    """
+    parser = ReferenceParser()
+
+    if unusual_separator.search(text):
+        for line in text.splitlines():
+            parser.line(line)
+
+        return parser.result()
+
+    text = text.replace('\r\n', '\n')
+    lines = text.split('\n')
+    if lines[-1] == '':
+        lines.pop()
+
+    i = 0
+    position = 0
+    for match in reference_event.finditer(text):
+        event = i + text.count('\n', position, match.start())
+        if event >= len(lines):
+            break
+
+        parser.block(lines[i:event])
+        parser.line(lines[event])
+
+        i = event + 1
+        position = match.end() + 1
+
+    parser.block(lines[i:])
+
+    return parser.result()
+
+
+def read_reference(path):
+    """Parse a reference model file, with its state, None when there is no such file"""
+    state = reference_state(path)
+    if state is None:
+        return None
+
+    text = path.read_text()
+    profile.count('bytes_read', len(text))
+
+    return state, scan_reference(text)
+
+
+def parse_reference(path):
+    """
+    Extract from a reference model the user regions, the traits it uses and what its class declaration adds after
+    the base class (implements ...), None when there is no such file. Parsed files are kept until they change
+    """
+    state = reference_state(path)
+    if state is None:
+        return None
+
+    cached = _references.get(str(path))
+    if cached is not None and cached[0] == state:
+        return cached[1]
+
+    parsed = read_reference(path)
+    if parsed is None:
+        return None
+
+    _references[str(path)] = parsed
+
+    return parsed[1]
+
+
+def load_references(states, regions, jobs=1):
+    """
+    Make the parsed reference files available to parse_reference: from the regions of the previous run when the
+    file kept its modification time and size, otherwise parsed again, over a process pool when more than one job
+    is requested. Return the regions to keep for the next run
+    """
+    result = {}
+    missing = []
+    for path, state in states.items():
+        if state is None:
+            continue
+
+        entry = regions.get(path)
+        if entry is not None and entry[:2] == state:
+            _references[path] = (state, entry[2])
+            result[path] = entry
+        else:
+            missing.append(path)
+
+    profile.count('references.cached', len(result))
+    profile.count('references.parsed', len(missing))
+
+    if jobs > 1 and len(missing) > jobs:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            chunksize = max(1, len(missing) // (jobs * 4))
+            parsed = list(executor.map(read_reference, map(Path, missing), chunksize=chunksize))
+    else:
+        parsed = [read_reference(Path(path)) for path in missing]
 
+    for path, item in zip(missing, parsed):
+        if item is not None:
+            _references[path] = item
+            result[path] = [item[0][0], item[0][1], item[1]]
+
+    return result
+
+
+def relation_names(table, tables, inflector):
+    """
+    Names of the relation methods of a table by side, then by related table and column. The plural names of the
+    one to many relations are inflected all at once
+    """
+    properties = tables[table]
+
+    key = properties.key
+    key_full = '%s_id' % table if key == 'id' else key
+
+    child = {}
+    many = []
+    for ref_table, columns in properties.child.items():
+        ref_key = tables[ref_table].key
+        ref_name = tables[ref_table].model
+        # the tables of another schema are keyed by schema and name, the schema prefixes their relation names
+        schema, _, ref_label = ref_table.rpartition('.')
+        schema_prefix = inflector.camelize(schema) if schema else ''
+
+        for column in columns:
+            column_full = '%s_id' % table if column == 'id' else column
+
+            if column == ref_key:
+                ref = schema_prefix + ref_name
+                child[ref_table, column] = ref[0].lower() + ref[1:]
+                continue
+
+            if column_full.startswith(key_full):
+                suffix = column_full.replace(key_full, '')
+                ref = inflector.camelize(ref_label + suffix)
+
+            elif key_full.endswith(column_full):
+                prefix = key_full.replace(column_full, '')
+                if not ref_label.startswith(prefix):
+                    ref = inflector.camelize(prefix + ref_label)
                 else:
-                    if column_full.startswith(key_full):
-                        suffix = column_full.replace(key_full, '')
-                        ref = camelize(ref_table + suffix)
-
-                    elif key_full.endswith(column_full):
-                        prefix = key_full.replace(column_full, '')
-                        if not ref_table.startswith(prefix):
-                            ref = camelize(prefix + ref_table)
-                        else:
-                            ref = camelize(ref_table)
-
-                    else:
-                        column_fulls = column_full.split('_')
-                        key_fulls = key_full.split('_')
-
-                        names = []
-                        for i in range(min(len(column_fulls), len(key_fulls))):
-                            if column_fulls[i] != key_fulls[i]:
-                                names.append(column_fulls[i])
-
-                        if names:
-                            ref = camelize('_'.join([ref_table] + names))
-                        else:
-                            ref = ref_name
-
-                    ref = plural(ref[0].lower() + ref[1:])
-                    type_length = max(type_length, len(ref_name) + 13 + 5)
-
-                    relations.append(('Collection|%s[]' % ref_name, ref))
-                    methods.append(template_one_to_many.format(
-                        ref=ref,
-                        namespace=namespace,
-                        model=ref_name,
-                        column=column,
-                        ref_column=ref_column
-                    ))
-                    use.append('use Illuminate\\Database\\Eloquent\\Relations\\HasMany;')
-
-        for ref_table, columns in sorted(properties['parent'].items()):
-            ref_key = tables[ref_table]['key']
-            ref_name = tables[ref_table]['name']
-
-            ref_key_full = '%s_id' % ref_table if ref_key == 'id' else ref_key
-
-            for column, ref_column in columns.items():
-                column_full = '%s_id' % table if column == 'id' else column
-
-                if column_full.startswith(ref_key_full):
-                    prefix = column_full.replace(ref_key_full, '')
-                    ref = camelize(ref_table + prefix)
+                    ref = inflector.camelize(ref_label)
+
+            else:
+                column_fulls = column_full.split('_')
+                key_fulls = key_full.split('_')
+
+                names = []
+                for i in range(min(len(column_fulls), len(key_fulls))):
+                    if column_fulls[i] != key_fulls[i]:
+                        names.append(column_fulls[i])
+
+                if names:
+                    ref = inflector.camelize('_'.join([ref_label] + names))
+                else:
+                    ref = ref_name
+
+            ref = schema_prefix + ref
+            many.append(((ref_table, column), ref[0].lower() + ref[1:]))
+
+    child.update(zip([name for name, ref in many], inflector.plural_all([ref for name, ref in many])))
+
+    parent = {}
+    for ref_table, columns in properties.parent.items():
+        ref_key = tables[ref_table].key
+        ref_name = tables[ref_table].model
+        schema, _, ref_label = ref_table.rpartition('.')
+        schema_prefix = inflector.camelize(schema) if schema else ''
 
+        ref_key_full = '%s_id' % ref_label if ref_key == 'id' else ref_key
+
+        for column in columns:
+            column_full = '%s_id' % table if column == 'id' else column
+
+            if column_full.startswith(ref_key_full):
+                prefix = column_full.replace(ref_key_full, '')
+                ref = inflector.camelize(ref_label + prefix)
+
+            else:
+                column_fulls = column_full.split('_')
+                ref_key_fulls = ref_key_full.split('_')
+
+                names = []
+                for i in range(min(len(column_fulls), len(ref_key_fulls))):
+                    if column_fulls[i] != ref_key_fulls[i]:
+                        names.append(column_fulls[i])
+
+                if names:
+                    ref = inflector.camelize('_'.join([ref_label] + names))
                 else:
-                    column_fulls = column_full.split('_')
-                    ref_key_fulls = ref_key_full.split('_')
+                    ref = ref_name
+
+            ref = schema_prefix + ref
+            parent[ref_table, column] = ref[0].lower() + ref[1:]
+
+    return {'child': child, 'parent': parent}
+
+
+def related_model(properties, namespace):
+    """
+    Namespace and class of a related model, as the relation templates join them. The model of another schema is
+    fully qualified, so it reads right in the docblocks too
+    """
+    if properties.namespace is None:
+        return namespace, properties.model
+
+    return '', '\\%s\\%s' % (properties.namespace, properties.model)
+
+
+def php_literal(value, type_):
+    """PHP literal of a column default, typed after the PHP type of the column, mapped from its DATA_TYPE"""
+    if type_ == integer_type:
+        if re.match(r'^-?\d+$', value):
+            return value
+
+        # bit columns
+        bits = re.match(r"^b'([01]+)'$", value)
+        if bits:
+            return str(int(bits.group(1), 2))
+
+    elif type_ == float_type:
+        if re.match(r'^-?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?$', value):
+            return value
+
+    elif type_ == boolean_type:
+        return 'false' if value in ['0', "b'0'"] else 'true'
+
+    return "'%s'" % value.replace('\\', '\\\\').replace("'", "\\'")
+
 
-                    names = []
-                    for i in range(min(len(column_fulls), len(ref_key_fulls))):
-                        if column_fulls[i] != ref_key_fulls[i]:
-                            names.append(column_fulls[i])
+def eager_relations(table, names, settings):
+    """
+    Parent relations of the model to eager load, in the configured order. The model-override list replaces the
+    global one, auto standing for every relation to another constant table, a self reference would load the
+    parent of every parent
+    """
+    eager_load = settings['eager_load']
+    parents = names['parent']
+    additional = settings['additional_parents'].get(table, {})
 
-                    if names:
-                        ref = camelize('_'.join([ref_table] + names))
-                    else:
-                        ref = ref_name
+    result = []
+    for entry in eager_load.get(table, eager_load.get(None)) or []:
+        if entry == eager_load_auto:
+            refs = [ref for (ref_table, column), ref in sorted(parents.items())
+                    if ref_table in settings['extract_const'] and ref_table != table]
+        elif entry in additional or entry in parents.values():
+            refs = [entry]
+        else:
+            _log.warning('%s has no parent relation %s to eager load', table, entry)
+            refs = []
+
+        result.extend(ref for ref in refs if ref not in result)
+
+    return result
+
+
+def render_model(table, tables, table_consts, settings, templates):
+    """Render the PHP source of the model of a table"""
+    path_ref = settings['path_ref']
+    namespace = settings['namespace']
+    history_suffix = settings['history_suffix']
+    always_add_region = settings['always_add_region']
+    base_class = settings['base_class']
+    base_namespace = settings['base_namespace']
+    base_classes = settings['base_classes']
+    additional_properties = settings['additional_properties']
+    additional_children = settings['additional_children']
+    additional_parents = settings['additional_parents']
+    additional_methods = settings['additional_methods']
+    additional_docblock = settings['additional_docblock']
+
+    properties = tables[table]
+
+    key = properties.key
+    name = properties.model
+
+    names = relation_names(table, tables, settings['inflector'])
+
+    reference = None
+    if path_ref is not None:
+        with profile.stage('reference'):
+            reference = parse_reference(Path(path_ref) / (name + '.php'))
+
+    # scopes already written by hand in the reference win over the generated ones
+    user_functions = '\n'.join(reference['functions']) if reference is not None else ''
+
+    # a stub table or a version 1 snapshot has no index loaded, unlike a table without any index
+    loaded = uses_indexes(settings) and properties.indexes is not None
+    prefixes = index_prefixes(properties) if loaded else []
+    indexed = {columns[0] for columns, index in prefixes}
+    scopes = {}
+    if settings['index_scope']:
+        for columns, index in prefixes:
+            method = 'And'.join(camelize(column) for column in columns)
+            if ('function scopeBy%s(' % method) not in user_functions:
+                scopes[columns] = (method, index)
+
+    use = [
+        'use %s;' % base_namespace,
+        'use Illuminate\\Database\\Eloquent\\Collection;',
+        'use Illuminate\\Database\\Eloquent\\Builder;',
+    ]
+
+    docs = []
+    const = ''
+    hidden = []
+    methods = []
+    fillable = ["        '%s'" % column for column in properties.fillable]
+    dates = []
+    casts = []
+
+    additional_property = []
+
+    props = []
+    wheres = []
+    relations = []
+    prop_types = {}
+
+    doc_methods = []
+
+    for field, value in additional_properties.get(table, {}).items():
+        if isinstance(value, list):
+            value = "[\n        '%s'\n    ]" % "',\n        '".join(value)
+        elif isinstance(value, str):
+            value = "'%s'" % value
+        elif isinstance(value, bool):
+            value = '%s' % ('true' if value else 'false')
+        else:
+            value = '%r' % value
+
+        docblock = ''
+        if field in additional_docblock.get('property', {}):
+            lines = additional_docblock['property'][field].splitlines()
+            docblock = '\n%s' % ''.join('    %s\n' % line for line in lines)
+
+        additional_property.append('%s    protected $%s = %s;\n' % (docblock, field, value))
+
+    # add history related method if table history exists
+    if history_suffix and (table + history_suffix) in tables:
+        methods.append(templates[history_templates[settings['history_mode']]].render(
+            table=table,
+            history=table + history_suffix,
+            key=key,
+            model=name,
+            columns=', '.join("'%s'" % column for column in properties.columns)
+        ))
+
+    if table in table_consts and table_consts[table]:
+        const = ''.join(['\n    ', '\n    '.join(table_consts[table]), '\n'])
+
+    rules = settings['cast_rules'].get(table) or settings['cast_rules'][None]
+
+    column_length = 0
+    type_length = 0
+
+    for column in properties.columns:
+        if column not in properties.date:
+            column_length = max(column_length, len(column))
+
+    for column, definition in properties.columns.items():
+        col_type = definition.type
+        if col_type in [date_type, datetime_type]:
+            use.append('use Carbon\\Carbon;')
+            prop_type = 'Carbon'
+        else:
+            prop_type = col_type
+
+        method = camelize(column)
+
+        if column in properties.nullable:
+            prop_type = 'null|' + prop_type
+        type_length = max(type_length, len(prop_type))
+
+        if column in properties.hidden:
+            hidden.append("        '%s'" % column)
+
+        props.append((prop_type, column))
+        prop_types[column] = prop_type
+
+        if not loaded or column in indexed or not settings['unindexed_where']:
+            wheres.append('@method static Builder|%s where%s($value)' % (name, method))
+        elif settings['unindexed_where'] == 'warn':
+            warning = settings['unindexed_warning']
+            wheres.append('@method static Builder|%s where%s($value) %s' % (name, method, warning))
 
-                ref = ref[0].lower() + ref[1:]
+        cast = rules.cast(column)
+        if cast is not None:
+            casts.append("        '%s'%s => '%s'" % (column, ' ' * (column_length - len(column)), cast))
+        else:
+            if column in properties.date:
+                dates.append("        '%s'" % column)
+            elif column not in ['created_at', 'updated_at']:
+                casts.append("        '%s'%s => '%s'" % (column, ' ' * (column_length - len(column)), col_type))
+
+    # relation
+    for ref_table, columns in sorted(properties.child.items()):
+        ref_key = tables[ref_table].key
+        ref_namespace, ref_name = related_model(tables[ref_table], namespace)
+
+        for column, foreign_key in columns.items():
+            ref_column = foreign_key.ref_column
+            ref = names['child'][ref_table, column]
+
+            if column == ref_key:
                 type_length = max(type_length, len(ref_name) + 5)
 
                 relations.append((ref_name, ref))
-                methods.append(template_many_to_one.format(
-                    ref=ref,
-                    namespace=namespace,
+                methods.append(templates['one_to_one'].partial(
+                    namespace=ref_namespace,
                     model=ref_name,
                     column=column,
                     ref_column=ref_column
-                ))
-                use.append('use Illuminate\\Database\\Eloquent\\Relations\\BelongsTo;')
+                ).render(ref=ref))
+                use.append('use Illuminate\\Database\\Eloquent\\Relations\\HasOne;')
 
-        if table in additional_children:
-            for ref, ref_name in additional_children[table].items():
+            else:
                 type_length = max(type_length, len(ref_name) + 13 + 5)
 
                 relations.append(('Collection|%s[]' % ref_name, ref))
+                methods.append(templates['one_to_many'].partial(
+                    namespace=ref_namespace,
+                    model=ref_name,
+                    column=column,
+                    ref_column=ref_column
+                ).render(ref=ref))
+                use.append('use Illuminate\\Database\\Eloquent\\Relations\\HasMany;')
+
+    for ref_table, columns in sorted(properties.parent.items()):
+        ref_key = tables[ref_table].key
+        ref_namespace, ref_name = related_model(tables[ref_table], namespace)
+
+        for column, foreign_key in columns.items():
+            ref_column = foreign_key.ref_column
+            ref = names['parent'][ref_table, column]
+
+            type_length = max(type_length, len(ref_name) + 5)
+
+            relations.append((ref_name, ref))
+            methods.append(templates['many_to_one'].partial(
+                namespace=ref_namespace,
+                model=ref_name,
+                column=column,
+                ref_column=ref_column
+            ).render(ref=ref))
+            use.append('use Illuminate\\Database\\Eloquent\\Relations\\BelongsTo;')
+
+    # model event listeners, registered by a single booted()
+    listeners = []
+
+    value = settings['extract_const'].get(table)
+    if settings['const_cache'] and value in properties.columns:
+        use.append('use Illuminate\\Support\\Facades\\Cache;')
+
+        variable = camelize(value)
+        tag = settings['const_cache_tag']
+        methods.append(templates['const_cache'].render(
+            model=name,
+            table=table,
+            key=value,
+            variable=variable[:1].lower() + variable[1:],
+            ttl=settings['const_cache_ttl'],
+            tag=tag,
+            tags="['%s', '%s:%s']" % (tag, tag, table),
+        ))
+        listeners.append('static::saved(function () {\n            static::flushCache();\n        });')
+        listeners.append('static::deleted(function () {\n            static::flushCache();\n        });')
+
+    if listeners:
+        if 'function booted(' in user_functions:
+            _log.warning('%s already has a booted() method, its event listeners are not generated', name)
+        else:
+            methods.append(templates['booted'].render(listeners=''.join('\n        %s' % x for x in listeners)))
+
+    if settings['lazy_loading_guard'] and relations:
+        use.append('use LogicException;')
+        environments = settings['lazy_loading_environments']
+        methods.append(templates['lazy_loading'].render(
+            names=', '.join(environments),
+            environments=', '.join("'%s'" % environment for environment in environments)
+        ))
+
+    # keyset iteration on the primary key, for the tables too large to be loaded whole or paginated by OFFSET. The
+    # values of a column of a composite key repeat, the chunks would skip rows
+    bulk = (properties.primary == 1 and key in properties.columns and
+            bulk_table(properties.rows, properties.size, settings))
+    if bulk:
+        defined = [method for method in ['chunkByKey', 'lazyByKey', 'scopeUpdateInChunks', 'scopeDeleteInChunks']
+                   if ('function %s(' % method) in user_functions]
+        if defined:
+            _log.warning('%s already has a %s() method, its bulk helpers are not generated', name, defined[0])
+        else:
+            use.append('use Illuminate\\Support\\LazyCollection;')
+            methods.append(templates['bulk'].render(
+                model=name,
+                key=key,
+                order=', oldest first' if properties.autoincrement else '',
+            ))
 
-        if table in additional_parents:
-            for ref, ref_name in additional_parents[table].items():
-                type_length = max(type_length, len(ref_name) + 5)
+    # query scopes on the leftmost prefixes of the indexes, named apart from the dynamic where<Column>() of Eloquent
+    # which keeps taking any value
+    for columns, (method, index) in scopes.items():
+        params = scope_params(properties, columns, prop_types)
+        wheres.append('@method static Builder|%s by%s(%s)' % (
+            name, method, ', '.join(hint + variable for hint, variable, doc_type in params)))
+
+        doc_length = max([len('Builder')] + [len(doc_type) for hint, variable, doc_type in params])
+        methods.append(templates['scope'].render(
+            columns=', '.join(columns),
+            index=index,
+            method='By' + method,
+            params_doc='\n'.join(['     * @param %s%s $query' % ('Builder', ' ' * (doc_length - 7))] + [
+                '     * @param %s%s %s' % (doc_type, ' ' * (doc_length - len(doc_type)), variable)
+                for hint, variable, doc_type in params]),
+            params=''.join(', %s%s' % (hint, variable) for hint, variable, doc_type in params),
+            wheres=''.join("->where('%s', %s)" % (column, param[1]) for column, param in zip(columns, params)),
+        ))
+
+    if table in additional_children:
+        for ref, ref_name in additional_children[table].items():
+            type_length = max(type_length, len(ref_name) + 13 + 5)
+
+            relations.append(('Collection|%s[]' % ref_name, ref))
+
+    if table in additional_parents:
+        for ref, ref_name in additional_parents[table].items():
+            type_length = max(type_length, len(ref_name) + 5)
+
+            relations.append((ref_name, ref))
+
+    if props:
+        props = ['@property %s%s $%s' % (prop_type, ' ' * (type_length - len(prop_type)), column) for
+                 prop_type, column in props]
+        docs.append('\n * '.join(props))
+
+    if relations:
+        relations = sorted(relations, key=lambda x: ('1%s' % x[1]) if x[0][0] == 'C' else ('2%s' % x[1]))
+        relations = ['@property-read %s%s $%s' % (ref_name, ' ' * (type_length - len(ref_name) - 5), ref) for
+                     ref_name, ref in relations]
+        docs.append('\n * '.join(relations))
+
+    if wheres:
+        docs.append('\n * '.join(wheres))
+
+    docs.append('\n * '.join([
+        '@method static Builder|%s query()' % (name,),
+    ]))
+
+    # with a shared base class, the models extending the default base class only carry their own data
+    shared = settings['shared_base_class'] if table not in base_classes else None
+
+    # the compact models inherit the all() and get() annotations, they are declared again to carry the warning
+    if bulk and shared:
+        docs.append('\n * '.join([
+            "@method static Collection|%s[] all($columns = ['*']) %s" % (name, bulk_warning),
+            "@method static Collection|%s[] get($columns = ['*']) %s" % (name, bulk_warning),
+        ]))
 
-                relations.append((ref_name, ref))
+    if table in base_classes:
+        base, cls = base_classes[table]
+        use.append('use %s;' % cls)
+        use.remove('use %s;' % base_namespace)
+    elif shared:
+        base = shared
+        use.remove('use %s;' % base_namespace)
+    else:
+        base = base_class
 
-        if props:
-            props = ['@property %s%s $%s' % (prop_type, ' ' * (type_length - len(prop_type)), column) for
-                     prop_type, column in props]
-            docs.append('\n * '.join(props))
+    if table in additional_methods:
+        for method in additional_methods[table]:
+            doc_methods.append(' * @method %s' % method)
 
-        if relations:
-            relations = sorted(relations, key=lambda x: ('1%s' % x[1]) if x[0][0] == 'C' else ('2%s' % x[1]))
-            relations = ['@property-read %s%s $%s' % (ref_name, ' ' * (type_length - len(ref_name) - 5), ref) for
-                         ref_name, ref in relations]
-            docs.append('\n * '.join(relations))
+    if 'deleted_at' in properties.columns:
+        use.append('use Illuminate\\Database\\Eloquent\\SoftDeletes;')
 
-        if wheres:
-            docs.append('\n * '.join(wheres))
+    use = use_block(use)
+    docs = '\n *\n * '.join(docs)
+    fillable = ',\n'.join(fillable)
+    dates = ',\n'.join(dates)
+    hidden = ',\n'.join(hidden)
+    casts = ',\n'.join(casts)
+    methods = ''.join(methods)
 
-        docs.append('\n * '.join([
-            '@method static Builder|%s query()' % (name,),
-        ]))
+    if use:
+        use += '\n'
 
-        if table in base_classes:
-            base, cls = base_classes[table]
-            use.append('use %s;' % cls)
-            use.remove('use %s;' % base_namespace)
-        else:
-            base = base_class
+    if docs and shared:
+        docs = '\n *\n * %s' % docs
+    elif docs:
+        docs = '\n * %s\n *' % docs
 
-        if table in additional_methods:
-            for method in additional_methods[table]:
-                doc_methods.append(' * @method %s' % method)
+    if fillable:
+        fillable = '\n%s,\n    ' % fillable
 
-        if 'deleted_at' in properties['column']:
-            use.append('use Illuminate\\Database\\Eloquent\\SoftDeletes;')
+    if dates:
+        dates = '\n%s,\n    ' % dates
 
-        use = '\n'.join(sorted(set(use)))
-        docs = '\n *\n * '.join(docs)
-        fillable = ',\n'.join(fillable)
-        dates = ',\n'.join(dates)
-        hidden = ',\n'.join(hidden)
-        casts = ',\n'.join(casts)
-        methods = ''.join(methods)
+    if hidden:
+        hidden = '\n%s,\n    ' % hidden
 
-        if use:
-            use += '\n'
+    if casts:
+        casts = '\n%s,\n    ' % casts
+
+    if doc_methods:
+        doc_methods = '\n *\n%s' % '\n'.join(doc_methods)
+    else:
+        doc_methods = ''
+
+    if additional_property:
+        additional_property = '\n\n'.join(additional_property)
+    else:
+        additional_property = ''
+
+    # defaults filled in by the database, the expressions only noted since the model can't evaluate them
+    if (properties.defaults or properties.computed) and 'attributes' not in additional_properties.get(table, {}):
+        length = max(len(column) for column in properties.defaults) if properties.defaults else 0
+        attributes = ',\n'.join("        '%s'%s => %s" % (
+            column, ' ' * (length - len(column)), php_literal(value, properties.columns[column].type))
+            for column, value in properties.defaults.items())
+        computed = ''
+        if properties.computed:
+            computed = ''.join('\n     *   %s: %s' % (column, value) for column, value in properties.computed.items())
+            computed = '\n     *\n     * Set by the database, refresh() the model after saving it to read:%s' % computed
+
+        additional_property = templates['attributes'].render(
+            attributes='\n%s,\n    ' % attributes if attributes else '',
+            computed=computed,
+        ) + additional_property
+
+    # parent relations loaded along with every query of the model, unless $with is set by hand
+    eager = eager_relations(table, names, settings)
+    if eager and 'with' not in additional_properties.get(table, {}):
+        additional_property = templates['eager_load'].render(
+            relations=''.join("\n        '%s'," % ref for ref in eager)
+        ) + additional_property
+
+    traits = []
+
+    if reference is not None:
+        for extends in reference['extends']:
+            base += ' %s' % extends
+
+        traits = reference['traits']
+
+        additional_ns = '\n'.join(reference['namespaces'])
+        if additional_ns:
+            use = '%s\n//region %s\n%s\n//endregion\n' % (use, namespace_mark, additional_ns)
+        elif always_add_region:
+            use = '%s\n//region %s\n//endregion\n' % (use, namespace_mark)
 
-        if docs:
-            docs = '\n * %s\n *' % docs
+        additional_function = '\n'.join(reference['functions'])
+        if additional_function:
+            methods = '%s\n    //region %s\n%s\n    //endregion\n' % (methods, function_mark, additional_function)
+        elif always_add_region:
+            methods = '%s\n    //region %s\n    //endregion\n' % (methods, function_mark)
 
-        if fillable:
-            fillable = '\n%s,\n    ' % fillable
+    elif always_add_region:
+        use = '%s\n//region %s\n//endregion\n' % (use, namespace_mark)
+        methods = '%s\n    //region %s\n    //endregion\n' % (methods, function_mark)
 
-        if dates:
-            dates = '\n%s,\n    ' % dates
+    if traits:
+        const = '\n%s\n%s' % ('\n'.join(traits), const)
 
-        if hidden:
-            hidden = '\n%s,\n    ' % hidden
+    if 'deleted_at' in properties.columns and 'SoftDeletes' not in const:
+        if const:
+            const = '\n    use SoftDeletes;\n%s' % const
+        else:
+            const = '\n    use SoftDeletes;\n'
+
+    # the compact models leave out the properties keeping the value they have on the Eloquent model
+    declarations = cast_declaration = ''
+    if shared:
+        declarations = ''.join('\n    %s;\n' % line for line in [
+            "protected $primaryKey = '%s'" % key if key != 'id' else None,
+            'public $incrementing = false' if not properties.autoincrement else None,
+            'public $timestamps = false' if not properties.timestamps else None,
+            'protected $hidden = [%s]' % hidden if hidden else None,
+            'protected $fillable = [%s]' % fillable if fillable else None,
+            'protected $dates = [%s]' % dates if dates else None,
+        ] if line is not None)
 
         if casts:
-            casts = '\n%s,\n    ' % casts
+            cast_declaration = '\n    protected $casts = [%s];\n' % casts
+
+    text = templates['model_compact' if shared else 'model'].render(
+        namespace=namespace,
+        use=use,
+        name=name,
+        const=const,
+        docs=docs,
+        doc_methods=doc_methods,
+        bulk_warning=' ' + bulk_warning if bulk else '',
+        base=base,
+        table=table,
+        key=key,
+        incrementing='true' if properties.autoincrement else 'false',
+        timestamps='true' if properties.timestamps else 'false',
+        hidden=hidden,
+        fillable=fillable,
+        dates=dates,
+        casts=casts,
+        declarations=declarations,
+        cast_declaration=cast_declaration,
+        property=additional_property,
+        methods=methods
+    )
 
-        if doc_methods:
-            doc_methods = '\n *\n%s' % '\n'.join(doc_methods)
-        else:
-            doc_methods = ''
+    return text
 
-        if additional_property:
-            additional_property = '\n\n'.join(additional_property)
-        else:
-            additional_property = ''
-
-        traits = []
-
-        f = None if path_ref is None else (Path(path_ref) / (name + '.php'))
-        if f is not None and f.exists():
-            is_namespace = False
-            is_trait = False
-            is_function = False
-
-            regions = []
-            additional_ns = []
-            additional_function = []
-
-            old_texts = f.read_text().splitlines()
-            for line in old_texts:
-                line_stripped = line.strip()
-
-                if line.startswith('class') and 'extends' in line_stripped:
-                    is_trait = True
-                    lines = line_stripped.split(' ')
-                    if len(lines) > 4:
-                        base += ' %s' % ' '.join(lines[4:])
-
-                elif line_stripped.startswith('//region'):
-                    region = line_stripped.replace('//region', '').strip()
-                    regions.append(region)
-
-                    if region == namespace_mark:
-                        is_namespace = True
-                    elif region == function_mark:
-                        is_function = True
-                    elif is_namespace:
-                        additional_ns.append(line)
-                    elif is_function:
-                        additional_function.append(line)
-
-                elif line_stripped.startswith('//endregion'):
-                    region = regions.pop(-1)
-
-                    if region == namespace_mark:
-                        is_namespace = False
-                    elif region == function_mark:
-                        is_function = False
-                    elif is_namespace:
-                        additional_ns.append(line)
-                    elif is_function:
-                        additional_function.append(line)
-
-                elif is_trait:
-                    if line_stripped.startswith('use'):
-                        traits.append(line)
-                    elif not line_stripped:
-                        is_trait = False
-
-                elif is_namespace:
-                    additional_ns.append(line)
-
-                elif is_function:
-                    additional_function.append(line)
-
-            additional_ns = '\n'.join(additional_ns)
-            if additional_ns:
-                use = '%s\n//region %s\n%s\n//endregion\n' % (use, namespace_mark, additional_ns)
-            elif always_add_region:
-                use = '%s\n//region %s\n//endregion\n' % (use, namespace_mark)
-
-            additional_function = '\n'.join(additional_function)
-            if additional_function:
-                methods = '%s\n    //region %s\n%s\n    //endregion\n' % (methods, function_mark, additional_function)
-            elif always_add_region:
-                methods = '%s\n    //region %s\n    //endregion\n' % (methods, function_mark)
 
-        elif always_add_region:
-            use = '%s\n//region %s\n//endregion\n' % (use, namespace_mark)
-            methods = '%s\n    //region %s\n    //endregion\n' % (methods, function_mark)
+def render_profiled(table, tables, table_consts, settings, templates):
+    """render_model, recording the time spent on the table when profiling"""
+    if not profile.enabled:
+        return render_model(table, tables, table_consts, settings, templates)
+
+    wall = time.perf_counter()
+    cpu = time.process_time()
+
+    text = render_model(table, tables, table_consts, settings, templates)
+
+    profile.tables[table] = (time.perf_counter() - wall, time.process_time() - cpu)
+
+    return text
+
+
+_worker = {}
+
+
+def _init_worker(tables, table_consts, settings, templates, references, profiling):
+    _worker.update(tables=tables, table_consts=table_consts, settings=settings, templates=templates)
+    _references.update(references)
+    profile.enabled = profiling
+
+
+def _render_worker(table):
+    profile.reset()
+    text = render_profiled(table, _worker['tables'], _worker['table_consts'], _worker['settings'], _worker['templates'])
+
+    return text, profile.export() if profile.enabled else None
+
+
+def render_models(pending, tables, table_consts, settings, templates, jobs=1):
+    """
+    Render the model of each pending table, in the same order, fanning the work out over a process pool when
+    more than one job is requested. The shared data reaches each worker once through the pool initializer, only
+    the table names are sent along with the work
+    """
+    if jobs <= 1 or len(pending) <= 1:
+        for table in pending:
+            yield render_profiled(table, tables, table_consts, settings, templates)
+        return
+
+    # multiprocessing.Pool rather than ProcessPoolExecutor, whose initializer needs python 3.7
+    chunksize = max(1, len(pending) // (jobs * 4))
+    initargs = (tables, table_consts, settings, templates, dict(_references), profile.enabled)
+    with multiprocessing.Pool(jobs, initializer=_init_worker, initargs=initargs) as pool:
+        for text, data in pool.imap(_render_worker, pending, chunksize=chunksize):
+            if data is not None:
+                profile.merge(data)
+
+            yield text
+
+
+def model_unchanged(f, text, digest, manifest, exists):
+    """
+    Whether the model file already has this content. A file still matching its manifest entry is compared by hash
+    without being read, a file missing from the manifest is read back and compared
+    """
+    entry = manifest.get(f.name)
+    if entry is not None:
+        if entry[0] != digest:
+            return False
+
+        try:
+            stat = f.stat()
+        except OSError:
+            return False
 
-        if traits:
-            const = '\n%s\n%s' % ('\n'.join(traits), const)
+        return [stat.st_size, stat.st_mtime_ns] == entry[1:]
 
-        if 'deleted_at' in properties['column'] and 'SoftDeletes' not in const:
-            if const:
-                const = '\n    use SoftDeletes;\n%s' % const
+    if not exists:
+        return False
+
+    try:
+        old_text = f.read_text()
+    except OSError:
+        return False
+
+    profile.count('bytes_read', len(old_text))
+    if old_text != text:
+        return False
+
+    stat = f.stat()
+    manifest[f.name] = [digest, stat.st_size, stat.st_mtime_ns]
+
+    return True
+
+
+def stage_model(f, text):
+    """Write the model next to its final path, the temporary file is renamed over it by commit_models"""
+    tmp = f.with_name('.%s.tmp' % f.name)
+    with tmp.open(mode='w', newline='\n') as fd:
+        fd.write(text)
+
+    profile.count('bytes_written', len(text))
+
+    return tmp
+
+
+def commit_models(staged, manifest):
+    """Rename every staged model over its final path and record it in the manifest"""
+    for tmp, f, digest in staged:
+        os.replace(str(tmp), str(f))
+
+        stat = f.stat()
+        manifest[f.name] = [digest, stat.st_size, stat.st_mtime_ns]
+
+    profile.count('files.written', len(staged))
+
+
+def discard_staged(staged):
+    for tmp, f, digest in staged:
+        try:
+            tmp.unlink()
+        except OSError:
+            pass
+
+
+def write_models(rendered, existing_models, manifest, progress=None, staged=None):
+    """
+    Write the rendered models whose content changed. Every model goes to a temporary file first, all of them are
+    renamed at the end so an interrupted run leaves the previous models in place. progress is the logging
+    interval and the number of models. Given a staged list, the models are only staged into it, the caller
+    committing them along with those of its other batches. Return the written tables
+    """
+    commit = staged is None
+    if commit:
+        staged = []
+
+    written = []
+    try:
+        for i, (table, f, text) in enumerate(rendered):
+            if progress is not None and i % progress[0] == 0:
+                _log.info('processing table %s (%d/%d)', table, i + 1, progress[1])
+
+            with profile.stage('write'):
+                exists = f.name in existing_models
+                existing_models.discard(f.name)
+
+                digest = hashlib.sha1(text.encode('utf-8')).hexdigest()
+                if model_unchanged(f, text, digest, manifest, exists):
+                    profile.count('files.unchanged')
+                    continue
+
+                staged.append((stage_model(f, text), f, digest))
+                written.append(table)
+
+        if commit:
+            with profile.stage('write'):
+                commit_models(staged, manifest)
+
+    except BaseException:
+        if commit:
+            discard_staged(staged)
+        raise
+
+    return written
+
+
+def audit_tables(tables, batch, settings):
+    """
+    Query performance problems of the tables of a batch, found from their definition, indexes and estimated row
+    counts. Every foreign key is checked from its child table
+    """
+    large_rows = settings['audit_table_rows']
+    fan_out = settings['audit_fan_out']
+
+    findings = []
+    for table in batch:
+        properties = tables[table]
+        indexes = properties.indexes
+        leading = {columns[0] for index, columns in indexes or ()}
+        primary = properties.primary > 0
+        if indexes is not None:
+            primary = any(index == 'PRIMARY' for index, columns in indexes)
+
+        for ref_table, columns in sorted(properties.parent.items()):
+            parent_rows = tables[ref_table].rows
+
+            for column, foreign_key in columns.items():
+                relation = '%s.%s' % (ref_table, foreign_key.ref_column)
+                kind = 'hasOne' if column == properties.key else 'hasMany'
+
+                if indexes is not None and column not in leading:
+                    findings.append({
+                        'check': 'unindexed_foreign_key',
+                        'table': table,
+                        'column': column,
+                        'detail': '%s from %s scans %s, no index leads with %s' % (kind, relation, table, column),
+                    })
+
+                if kind == 'hasMany' and parent_rows and properties.rows is not None:
+                    ratio = properties.rows / parent_rows
+                    if ratio >= fan_out:
+                        findings.append({
+                            'check': 'fan_out',
+                            'table': table,
+                            'column': column,
+                            'detail': '%s from %s loads about %d rows per %s row, eager load or paginate it' % (
+                                kind, relation, ratio, ref_table),
+                        })
+
+        if properties.rows is not None and properties.rows >= large_rows:
+            problem = None
+            if not primary:
+                problem = 'no primary key'
+            elif properties.primary > 1:
+                problem = 'composite primary key'
+            elif not properties.autoincrement:
+                problem = 'primary key %s is not auto-incremented' % properties.key
+
+            if problem is not None:
+                findings.append({
+                    'check': 'large_table_key',
+                    'table': table,
+                    'column': properties.key if primary and properties.primary == 1 else None,
+                    'detail': '%s with about %d rows' % (problem, properties.rows),
+                })
+
+        for column in properties.columns:
+            if column in properties.large and column not in properties.hidden:
+                findings.append({
+                    'check': 'large_column',
+                    'table': table,
+                    'column': column,
+                    'detail': 'serialized by toArray() and toJson(), add it to hidden_column',
+                })
+
+    return findings
+
+
+def write_audit(path, findings, settings, count):
+    """Write the audit findings as JSON to path, and as a readable summary next to it with a .txt suffix"""
+    order = {check: i for i, (check, title) in enumerate(audit_checks)}
+    findings = sorted(findings, key=lambda x: (order[x['check']], x['table'], x['column'] or ''))
+    summary = {check: 0 for check, title in audit_checks}
+    for finding in findings:
+        summary[finding['check']] += 1
+
+    path.write_text(json.dumps({
+        'database': settings['db'].get('database'),
+        'tables': count,
+        'thresholds': {'large_table_rows': settings['audit_table_rows'], 'fan_out': settings['audit_fan_out']},
+        'summary': summary,
+        'findings': findings,
+    }, indent=2))
+
+    lines = ['Audit of %s, %d tables, %d findings' % (settings['db'].get('database'), count, len(findings))]
+    for check, title in audit_checks:
+        lines.append('')
+        lines.append('%s (%d)' % (title, summary[check]))
+        for finding in findings:
+            if finding['check'] == check:
+                name = finding['table'] if finding['column'] is None else '%(table)s.%(column)s' % finding
+                lines.append('  %s: %s' % (name, finding['detail']))
+
+    path.with_suffix('.txt').write_text('\n'.join(lines) + '\n')
+
+
+def write_shared_base(settings, templates, existing_models, manifest):
+    """Write the abstract class extended by the models when shared_base_class is set, return its file name"""
+    name = settings['shared_base_class']
+    if not name:
+        return None
+
+    f = settings['path_model'] / (name + '.php')
+    text = templates['model_base'].render(
+        namespace=settings['namespace'],
+        use=use_block(['use %s;' % settings['base_namespace'], 'use Illuminate\\Database\\Eloquent\\Collection;']),
+        name=name,
+        base=settings['base_class'],
+    )
+    write_models([(name, f, text)], existing_models, manifest)
+
+    return f.name
+
+
+def use_names(lines):
+    """Class names imported by use statements, by their short name or alias"""
+    names = {}
+    for line in lines:
+        line = line.strip()
+        if not line.startswith('use ') or not line.endswith(';'):
+            continue
+
+        for name in line[4:-1].split(','):
+            name = name.strip().lstrip('\\')
+            if ' as ' in name:
+                name, alias = [x.strip() for x in name.split(' as ')]
             else:
-                const = '\n    use SoftDeletes;\n'
-
-        text = template_model.format(
-            namespace=namespace,
-            use=use,
-            name=name,
-            const=const,
-            docs=docs,
-            doc_methods=doc_methods,
-            base=base,
-            table=table,
-            key=key,
-            incrementing=properties['autoincrement'],
-            timestamps=properties['timestamps'],
-            hidden=hidden,
-            fillable=fillable,
-            dates=dates,
-            casts=casts,
-            property=additional_property,
-            methods=methods
-        )
-
-        f = path_model / (name + '.php')
-        if f in existing_models:
-            existing_models.remove(f)
-            if f.read_text() == text:
-                continue
+                alias = name.split('\\')[-1]
+
+            names[alias] = name
+
+    return names
+
+
+def preload_entry(table, tables, settings):
+    """
+    Class, file and parent class of the model of a table for the preload script, the parent is None when the
+    reference merges a trait that isn't imported, the model is then left to the autoloader
+    """
+    name = tables[table].model
+    namespace = settings['namespace']
+
+    if table in settings['base_classes']:
+        parent = settings['base_classes'][table][1].split(' as ')[0].strip().lstrip('\\')
+    elif settings['shared_base_class']:
+        parent = '%s\\%s' % (namespace, settings['shared_base_class'])
+    elif '\\' in settings['base_class']:
+        parent = settings['base_class']
+    else:
+        parent = settings['base_namespace']
+
+    reference = None
+    if settings['path_ref'] is not None:
+        reference = parse_reference(Path(settings['path_ref']) / (name + '.php'))
+
+    if reference is not None:
+        imported = use_names(reference['namespaces'])
+        for line in reference['traits']:
+            for trait in line.strip()[4:].split('{')[0].rstrip(';').split(','):
+                trait = trait.strip()
+                if trait and not trait.startswith('\\') and trait not in imported and trait != 'SoftDeletes':
+                    _log.info('%s uses the unknown trait %s, left out of the preload script', name, trait)
+                    return '%s\\%s' % (namespace, name), name + '.php', None
+
+    return '%s\\%s' % (namespace, name), name + '.php', parent
+
+
+def write_preload(settings, templates, entries, existing_models, manifest):
+    """
+    Write the opcache.preload script: the facade aliases and the base classes first, then the models, a model
+    extending another generated model coming after it. Return its file name when it lives among the models
+    """
+    f = settings['preload_path']
+    path_model = settings['path_model']
+
+    models = {cls: (file, parent) for cls, file, parent in entries if parent is not None}
+
+    ordered = []
+    done = set()
+
+    def visit(cls):
+        if cls in done:
+            return
+
+        done.add(cls)
+        parent = models[cls][1]
+        if parent in models:
+            visit(parent)
+
+        ordered.append(cls)
+
+    for cls in sorted(models):
+        visit(cls)
+
+    parents = sorted({parent for file, parent in models.values() if parent not in models})
+    aliases = [alias for alias in parents if alias in facade_aliases]
+
+    # the shared base class itself extends the configured base, through its facade alias when it has one
+    if settings['shared_base_class'] and '%s\\%s' % (settings['namespace'], settings['shared_base_class']) in parents:
+        base = settings['base_class'] if '\\' in settings['base_class'] else settings['base_namespace']
+        if base in facade_aliases and base not in aliases:
+            aliases.append(base)
+
+    autoload = settings['preload_autoload']
+    folder = os.path.relpath(str(path_model), str(f.parent)).replace(os.sep, '/')
+    text = templates['preload'].render(
+        namespace=settings['namespace'],
+        autoload="\nrequire_once __DIR__ . '/%s';\n" % autoload if autoload else '',
+        aliases=''.join("\nclass_alias('%s', '%s');\n" % (facade_aliases[alias], alias) for alias in aliases),
+        classes=''.join("\n    '%s'," % (facade_aliases.get(parent, parent)) for parent in parents),
+        files=''.join("\n    '%s'," % posixpath.normpath(posixpath.join(folder, models[cls][0])) for cls in ordered),
+    )
+
+    if f.parent == path_model:
+        write_models([(None, f, text)], existing_models, manifest)
+        return f.name
+
+    write_models([(None, f, text)], {f.name} if f.exists() else set(), {})
+
+
+def config_path(config):
+    config = local / ('generator.ini' if config is None else config)
+    if not config.exists():
+        raise Exception('Unable to load configuration %s', config)
+
+    return config
+
 
-        with f.open(mode='w', newline='\n') as fd:
-            fd.write(text)
+def snapshot(config=None, output=None):
+    config = config_path(config)
+    settings = load_config(config)
 
-    _log.info('cleanup %s', path_model)
-    for f in existing_models:
-        f.unlink()
+    output = config.with_name(config.name + '.snapshot.jsonl.gz') if output is None else Path(output)
+
+    if settings['schemas']:
+        raise Exception('Snapshots are not supported with several schemas')
+
+    _log.info('connection')
+    with closing(connection.MySQLConnection(**settings['db'])) as cnx:
+        _log.info('writing snapshot %s', output)
+        write_snapshot(cnx, settings, output)
 
     _log.info('done')
 
 
+def schema_settings(settings, schema):
+    """Settings of one of the configured schemas, its database, namespace and paths replacing the global ones"""
+    options = settings['schemas'][schema]
+
+    cache_path = settings['cache_path']
+    manifest_path = settings['manifest_path']
+
+    return dict(
+        settings,
+        db=dict(settings['db'], database=schema),
+        namespace=options['namespace'],
+        path_model=options['path_model'],
+        path_ref=options['path_ref'],
+        preload_path=options['preload_path'],
+        cache_path=cache_path.with_name('%s.%s' % (cache_path.name, schema)) if cache_path else None,
+        manifest_path=manifest_path.with_name('%s.%s' % (manifest_path.name, schema)) if manifest_path else None,
+    )
+
+
+def generate_schemas(config, settings, jobs=1, only_tables=None, audit=None):
+    """
+    Generate the models of every configured schema. Their metadata is loaded once for all of them, then each
+    schema is rendered by generate in its own process, up to jobs at a time
+    """
+    schemas = list(settings['schemas'])
+
+    if only_tables is not None:
+        settings = dict(settings, include=list(only_tables))
+
+    _log.info('connection')
+    with profile.stage('connection'):
+        cnx = connection.MySQLConnection(**settings['db'])
+
+    try:
+        states = {}
+        if settings['cache_path'] is not None:
+            _log.info('checking schema state')
+            with profile.stage('schema_state'):
+                states = schema_state(cnx, settings, schemas)
+
+            # the stubs of a changed schema come from the others, they are all loaded unless none changed
+            templates = load_templates(settings['path_template'], local / 'template')
+            for schema in schemas:
+                current = schema_settings(settings, schema)
+                cache = load_cache(current['cache_path'], settings_fingerprint(current, templates))[0]
+                if audit is not None or not cache_is_fresh(cache, states[schema], current['path_model']):
+                    break
+            else:
+                _log.info('schemas unchanged, nothing to generate')
+                return
+
+        metadata = load_schemas(cnx, settings)
+
+    finally:
+        cnx.close()
+
+    arguments = [dict(config=config, only_tables=only_tables, audit=audit, schema=schema,
+                      metadata=metadata[schema] + (states.get(schema),)) for schema in schemas]
+
+    jobs = min(jobs, len(schemas))
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            for future in [executor.submit(generate, **kwargs) for kwargs in arguments]:
+                future.result()
+    else:
+        for kwargs in arguments:
+            generate(**kwargs)
+
+
+def generate(config=None, jobs=1, from_snapshot=None, only_tables=None, stream=None, audit=None, schema=None,
+             metadata=None):
+    """
+    Generate the models. audit is the path of a JSON audit report of the generated tables, written along with a
+    text summary, an empty path writes it next to the configuration. schema restricts the run to one of the
+    configured schemas, rendered from the tables, constants and schema state of metadata
+    """
+    # load configuration
+    config = config_path(config)
+    with profile.stage('configuration'):
+        settings = load_config(config)
+
+    if audit is not None:
+        audit = Path(audit) if audit else config.with_name(config.name + '.audit.json')
+        settings['audit'] = True
+
+    if schema is not None:
+        settings = schema_settings(settings, schema)
+        if audit is not None:
+            audit = audit.with_name('%s.%s' % (schema, audit.name))
+
+    elif settings['schemas']:
+        if from_snapshot is not None or stream is not None:
+            raise Exception('--from-snapshot and --stream are not supported with several schemas')
+
+        generate_schemas(config, settings, jobs, only_tables, audit)
+        return
+
+    path_model = settings['path_model']
+    path_ref = settings['path_ref']
+
+    if not path_model.exists():
+        path_model.mkdir(parents=True)
+
+    elif not path_model.is_dir():
+        raise Exception('Unable to use "%s" as path_model', path_model)
+
+    existing_models = {f.name for f in path_model.iterdir() if f.is_file()}
+
+    templates = load_templates(settings['path_template'], local / 'template')
+
+    settings_digest = settings_fingerprint(settings, templates)
+
+    with profile.stage('cache'):
+        cache, cache_regions = load_cache(settings['cache_path'], settings_digest)
+        manifest = load_manifest(settings['manifest_path'], path_model)
+
+    # targeted regeneration, the other models are left untouched
+    if only_tables is not None:
+        settings = dict(settings, include=list(only_tables))
+
+    fingerprints = {}
+    references = {}
+    regions = {}
+    files = []
+    findings = []
+    audited = 0
+    preload = []
+
+    # the models of every batch are staged, then renamed together once the last batch is rendered
+    staged = []
+
+    cnx = None
+    try:
+        if metadata is not None:
+            # loaded by generate_schemas along with the other schemas, the stubs of their tables are left out
+            tables, table_consts, state = metadata
+
+            if audit is None and cache_is_fresh(cache, state, path_model):
+                _log.info('schema %s unchanged, nothing to generate', schema)
+                return
+
+            batches = [(tables, table_consts, [table for table in tables if tables[table].namespace is None])]
+
+        elif from_snapshot is not None:
+            # everything comes from the snapshot, no database round trip at all
+            _log.info('loading snapshot %s', from_snapshot)
+            with profile.stage('snapshot'):
+                tables, table_consts, state = read_snapshot(Path(from_snapshot), settings)
+
+            if audit is None and cache_is_fresh(cache, state, path_model):
+                _log.info('schema unchanged, nothing to generate')
+                return
+
+            batches = [(tables, table_consts, list(tables))]
+
+        else:
+            # open connection to database then load table definition, load tabel relation and
+            # value constant if specified
+            _log.info('connection')
+            with profile.stage('connection'):
+                cnx = connection.MySQLConnection(**settings['db'])
+
+            state = None
+            if settings['cache_path'] is not None:
+                _log.info('checking schema state')
+                with profile.stage('schema_state'):
+                    state = schema_state(cnx, settings)
+
+            if audit is None and cache_is_fresh(cache, state, path_model):
+                _log.info('schema unchanged, nothing to generate')
+                return
+
+            if stream is not None:
+                batches = stream_metadata(cnx, settings, stream)
+            else:
+                if settings['pool_size'] > 1:
+                    tables, table_consts = load_metadata_pooled(settings)
+                else:
+                    tables, table_consts = load_metadata(cnx, settings)
+
+                batches = [(tables, table_consts, list(tables))]
+
+        for tables, table_consts, batch in batches:
+            pending = []
+            batch_references = {}
+
+            with profile.stage('fingerprint'):
+                for table in batch:
+                    if not table_selected(table, settings):
+                        continue
+
+                    name = tables[table].model
+
+                    # skip table whose model was rendered from exactly the same data on the previous run
+                    f = path_model / (name + '.php')
+                    files.append(f.name)
+
+                    reference = None
+                    if path_ref is not None:
+                        f_ref = Path(path_ref) / (name + '.php')
+                        reference = batch_references[str(f_ref)] = reference_state(f_ref)
+
+                    fingerprints[table] = table_fingerprint(table, tables, table_consts, settings, reference)
+                    if (cache is not None and cache['tables'].get(table) == fingerprints[table]
+                            and f.name in existing_models):
+                        existing_models.discard(f.name)
+                        profile.count('files.skipped')
+                        continue
+
+                    pending.append((table, f))
+
+            references.update(batch_references)
+
+            if settings['preload_path'] is not None:
+                preload.extend(preload_entry(table, tables, settings) for table in batch
+                               if table_selected(table, settings))
+
+            if audit is not None:
+                with profile.stage('audit'):
+                    selected = [table for table in batch if table_selected(table, settings)]
+                    findings.extend(audit_tables(tables, selected, settings))
+                    audited += len(selected)
+
+            with profile.stage('references'):
+                regions.update(load_references(batch_references, cache_regions, jobs))
+
+            # per table logging is sampled, it costs a lot on big schemas
+            progress = None
+            if stream is None:
+                progress = (max(1, len(pending) // 20), len(pending))
+            else:
+                _log.info('processing %d tables from %s', len(pending), batch[0])
+
+            with profile.stage('models'):
+                tables_pending = [table for table, f in pending]
+                texts = render_models(tables_pending, tables, table_consts, settings, templates, jobs)
+                rendered = ((table, f, text) for (table, f), text in zip(pending, texts))
+                write_models(rendered, existing_models, manifest, progress, staged)
+
+            if stream is not None:
+                # nothing of this batch is needed for the next one
+                _references.clear()
+                for template in templates.values():
+                    template.partials.clear()
+
+        with profile.stage('write'):
+            commit_models(staged, manifest)
+
+    except BaseException:
+        discard_staged(staged)
+        raise
+
+    finally:
+        if cnx is not None:
+            cnx.close()
+
+    base = write_shared_base(settings, templates, existing_models, manifest)
+    if base is not None:
+        files.append(base)
+
+    # a targeted regeneration only knows of the selected tables, the script of the previous run stays
+    if settings['preload_path'] is not None and only_tables is None:
+        _log.info('writing preload script %s', settings['preload_path'])
+        preload = write_preload(settings, templates, preload, existing_models, manifest)
+        if preload is not None:
+            files.append(preload)
+
+    if audit is not None:
+        _log.info('writing audit %s, %d findings', audit, len(findings))
+        write_audit(audit, findings, settings, audited)
+
+    if only_tables is None:
+        _log.info('cleanup %s', path_model)
+        for name in existing_models:
+            (path_model / name).unlink()
+            manifest.pop(name, None)
+            profile.count('files.removed')
+
+    elif cache is not None:
+        # keep what the previous run knew about the other tables, but not the schema state since they may have
+        # changed without being regenerated
+        fingerprints = dict(cache['tables'], **fingerprints)
+        references = dict(cache['references'], **references)
+        regions = dict(cache_regions, **regions)
+        files = sorted(set(cache['files']).union(files))
+        state = None
+
+    else:
+        regions = dict(cache_regions, **regions)
+        state = None
+
+    with profile.stage('cache'):
+        save_cache(settings['cache_path'], {
+            'version': cache_version,
+            'settings': settings_digest,
+            'state': state,
+            'tables': fingerprints,
+            'references': references,
+            'regions': regions,
+            'files': files,
+        })
+        save_manifest(settings['manifest_path'], path_model, manifest)
+
+    _log.info('done')
+
+
+def migrations_state(cnx, table):
+    """Number of rows and last id of a migrations table, which change with every migration run or rollback"""
+    with closing(cnx.cursor()) as cursor:
+        cursor.execute('SELECT COUNT(*), MAX(id) FROM %s' % table)
+        return list(cursor.fetchall()[0])
+
+
+def reload_tables(cnx, settings, tables, table_consts, changed):
+    """
+    Replace in place the definitions, relations and constants of the changed tables, dropping the tables which
+    no longer exist, and return the tables whose model may render differently: the changed tables and the
+    tables related to them before or after the change. As in a full load, only the selected tables, their history
+    tables and the tables related to them are loaded
+    """
+    ignore = settings['ignore']
+    history_suffix = settings['history_suffix']
+
+    def selected(table):
+        if table_selected(table, settings):
+            return True
+
+        return bool(history_suffix) and table.endswith(history_suffix) and table_selected(
+            table[:-len(history_suffix)], settings)
+
+    affected = set(changed)
+    known = set(tables)
+
+    # forget the old definitions and the foreign keys pointing to them from the unchanged tables
+    for table in changed:
+        properties = tables.pop(table, None)
+        table_consts.pop(table, None)
+        if properties is None:
+            continue
+
+        for ref_table in properties.parent:
+            affected.add(ref_table)
+            if ref_table in tables:
+                tables[ref_table].child.pop(table, None)
+
+        for ref_table in properties.child:
+            affected.add(ref_table)
+            if ref_table in tables:
+                tables[ref_table].parent.pop(table, None)
+
+    reload = sorted(table for table in changed
+                    if not table_matches(table, ignore) and (selected(table) or table in known))
+    if reload:
+        names = ', '.join(['%s'] * len(reload))
+
+        with closing(cnx.cursor()) as cursor:
+            cursor.execute('%s  AND (TABLE_NAME IN (%s) OR REFERENCED_TABLE_NAME IN (%s))\n' % (
+                relation_sql, names, names), reload + reload)
+            relations = cursor.fetchall()
+
+        # tables newly related to the changed ones may not have been loaded yet
+        missing = {table for row in relations if selected(row[0]) or selected(row[2]) for table in (row[0], row[2])
+                   if table not in tables and not table_matches(table, ignore)}
+        load = sorted(missing.union(reload))
+
+        with closing(cnx.cursor()) as cursor:
+            cursor.execute('%s  AND TABLE_NAME IN (%s)\n' % (columns_sql, ', '.join(['%s'] * len(load))), load)
+            loaded = build_tables(cursor, settings)
+
+        tables.update(loaded)
+        build_relation(tables, relations, ignore)
+
+        if uses_indexes(settings) and loaded:
+            load_indexes(cnx, tables, sorted(loaded))
+
+        if loads_table_rows(settings) and loaded:
+            with closing(cnx.cursor()) as cursor:
+                cursor.execute('%s  AND TABLE_NAME IN (%s)\n' % (table_rows_sql, ', '.join(['%s'] * len(loaded))),
+                               sorted(loaded))
+                build_table_rows(tables, cursor.fetchall())
+
+        for table in loaded:
+            affected.update(tables[table].parent, tables[table].child)
+
+        for table, keys, value in const_queries(loaded, settings):
+            table_consts[table] = load_const(cnx, table, keys, value)
+
+    # the history method lives on the model of the original table
+    if history_suffix:
+        affected.update(table[:-len(history_suffix)] for table in changed if table.endswith(history_suffix))
+
+    return affected
+
+
+def watch(config=None, interval=2.0, migrations=None, jobs=1):
+    """
+    Keep the models in sync with the schema: one connection stays open, the schema state is polled every interval
+    seconds, or only the migrations table when one is given, and only the models of the changed tables and of
+    the tables related to them are rendered again. The metadata and the parsed references stay in memory
+    """
+    settings = load_config(config_path(config))
+    templates = load_templates(settings['path_template'], local / 'template')
+
+    if settings['schemas']:
+        raise Exception('Watching is not supported with several schemas')
+
+    path_model = settings['path_model']
+    path_ref = settings['path_ref']
+
+    if not path_model.exists():
+        path_model.mkdir(parents=True)
+
+    def reference(table):
+        if path_ref is None:
+            return None
+
+        return reference_state(Path(path_ref) / (tables[table].model + '.php'))
+
+    manifest = load_manifest(settings['manifest_path'], path_model)
+
+    def update(affected, removed, jobs=1):
+        pending = sorted(table for table in affected if table in tables and table_selected(table, settings))
+
+        existing_models = {f.name for f in path_model.iterdir() if f.is_file()}
+        texts = render_models(pending, tables, table_consts, settings, templates, jobs)
+        written = write_models(((table, path_model / (tables[table].model + '.php'), text)
+                                for table, text in zip(pending, texts)), existing_models, manifest)
+
+        for table in pending:
+            references[table] = reference(table)
+
+        for table in written:
+            _log.info('updated model of %s', table)
+
+        if settings['preload_path'] is not None and (written or removed):
+            entries = [preload_entry(table, tables, settings) for table in sorted(tables)
+                       if table_selected(table, settings) and table not in removed]
+            write_preload(settings, templates, entries, existing_models, manifest)
+
+        for table in removed:
+            references.pop(table, None)
+            f = path_model / (camelize(table) + '.php')
+            manifest.pop(f.name, None)
+            if table_selected(table, settings) and f.is_file():
+                _log.info('removed model of %s', table)
+                f.unlink()
+
+        save_manifest(settings['manifest_path'], path_model, manifest)
+
+        return len(written)
+
+    _log.info('connection')
+    with closing(connection.MySQLConnection(**settings['db'])) as cnx:
+        state = schema_state(cnx, settings)
+        marker = migrations_state(cnx, migrations) if migrations else None
+        tables, table_consts = load_metadata(cnx, settings)
+
+        references = {}
+        update(tables, [], jobs)
+
+        models = {tables[table].model + '.php' for table in tables if table_selected(table, settings)}
+        base = write_shared_base(settings, templates, {f.name for f in path_model.iterdir() if f.is_file()}, manifest)
+        if base is not None:
+            models.add(base)
+
+        if settings['preload_path'] is not None and settings['preload_path'].parent == path_model:
+            models.add(settings['preload_path'].name)
+        for f in path_model.iterdir():
+            if f.is_file() and f.name not in models:
+                manifest.pop(f.name, None)
+                f.unlink()
+
+        save_manifest(settings['manifest_path'], path_model, manifest)
+
+        _log.info('watching %s every %s seconds', settings['db'].get('database'), interval)
+        try:
+            while True:
+                time.sleep(interval)
+
+                cnx.ping(reconnect=True, attempts=3, delay=1)
+
+                changed = set()
+                removed = set()
+                if migrations:
+                    current = migrations_state(cnx, migrations)
+                    if current != marker:
+                        marker = current
+                        changed = None
+                else:
+                    changed = None
+
+                if changed is None:
+                    current = schema_state(cnx, settings)
+                    changed = {table for table in set(state).union(current) if state.get(table) != current.get(table)}
+                    removed = set(state).difference(current)
+                    state = current
+
+                affected = reload_tables(cnx, settings, tables, table_consts, changed) if changed else set()
+
+                # reference files edited since their model was rendered
+                affected.update(table for table, stat in references.items()
+                                if table in tables and reference(table) != stat)
+
+                if affected:
+                    # only the tables dropped from the schema lose their model, not the ones left out of the selection
+                    removed = sorted(table for table in removed if table_selected(table, settings))
+                    written = update(affected, removed)
+                    _log.info('%d tables changed, %d models updated, %d removed', len(changed), written, len(removed))
+
+        except KeyboardInterrupt:
+            _log.info('stopped')
+
+
+def main(config=None, jobs=1, from_snapshot=None, only_tables=None, profile_path=None, profile_stats=None,
+         stream=None, audit=None):
+    """
+    Generate the models, optionally writing the time spent per stage and per table as JSON to profile_path and a
+    cProfile dump, readable with pstats, to profile_stats
+    """
+    profile.enabled = profile_path is not None
+    profile.reset()
+
+    profiler = None
+    if profile_stats is not None:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    try:
+        with profile.stage('total'):
+            generate(config, jobs=jobs, from_snapshot=from_snapshot, only_tables=only_tables, stream=stream,
+                     audit=audit)
+
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(str(profile_stats))
+
+        if profile_path is not None:
+            profile.write(Path(profile_path))
+
+
+def parse_args(argv):
+    # the command is optional so "generator.py config.ini" keeps working
+    command = 'generate'
+    if argv and argv[0] in commands:
+        command, argv = argv[0], argv[1:]
+
+    parser = argparse.ArgumentParser(description='Generate Eloquent models from a MySQL schema',
+                                     usage='%%(prog)s [{%s}] [config] [options]' % ','.join(commands))
+    parser.add_argument('config', nargs='?', help='configuration file, default to generator.ini')
+
+    if command == 'generate':
+        parser.add_argument('-j', '--jobs', type=int, default=1,
+                            help='number of processes rendering the models, 0 to use every cpu')
+        parser.add_argument('--from-snapshot', metavar='PATH',
+                            help='render the models from a snapshot instead of the database')
+        parser.add_argument('--tables', nargs='+', metavar='PATTERN',
+                            help='only regenerate the models of the tables matching these glob patterns')
+        parser.add_argument('--stream', type=int, nargs='?', const=500, metavar='TABLES',
+                            help='load and render the schema in batches of foreign key connected tables, '
+                                 '500 tables per batch by default, keeping memory flat on huge schemas. The models '
+                                 'of every batch are renamed in place together at the end')
+        parser.add_argument('--audit', nargs='?', const='', metavar='PATH',
+                            help='write a JSON report of the query performance problems of the schema, and a text '
+                                 'summary next to it, default to <config>.audit.json')
+        parser.add_argument('--profile', metavar='PATH',
+                            help='write the time spent per stage and per table, and I/O counters, as JSON')
+        parser.add_argument('--profile-stats', metavar='PATH',
+                            help='write a cProfile dump of the run, readable with pstats')
+
+    elif command == 'watch':
+        parser.add_argument('-i', '--interval', type=float, default=2.0,
+                            help='seconds between two polls of the schema, default to 2')
+        parser.add_argument('--migrations', metavar='TABLE',
+                            help='only check the schema when the rows of this migrations table change')
+        parser.add_argument('-j', '--jobs', type=int, default=1,
+                            help='number of processes rendering the models on start, 0 to use every cpu')
+
+    elif command == 'snapshot':
+        parser.add_argument('-o', '--output', metavar='PATH',
+                            help='snapshot file, compressed when ending with .gz, '
+                                 'default to <config>.snapshot.jsonl.gz')
+
+    args = parser.parse_args(argv)
+    args.command = command
+
+    return args
+
+
 if __name__ == '__main__':
-    main(sys.argv[1] if len(sys.argv) > 1 else None)
+    args = parse_args(sys.argv[1:])
+    if args.command == 'snapshot':
+        snapshot(args.config, output=args.output)
+    elif args.command == 'watch':
+        watch(args.config, interval=args.interval, migrations=args.migrations, jobs=args.jobs or os.cpu_count())
+    else:
+        main(args.config, jobs=args.jobs or os.cpu_count(), from_snapshot=args.from_snapshot,
+             only_tables=args.tables, profile_path=args.profile, profile_stats=args.profile_stats, stream=args.stream,
+             audit=args.audit)